@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from pyperaptor import Pipeline, Node, Device
+
+
+def sum1(x):
+    return x + 1
+
+
+def direct(x, n):
+    for _ in range(n):
+        x = sum1(x)
+    return x
+
+
+def bench_push_overhead(nodes=5, items=100000, repeat=5):
+    p = Pipeline([sum1] * nodes)
+    p.lock()
+
+    pushed = min(timeit.repeat(lambda: [p.push(i) for i in range(items)],
+                               number=1, repeat=repeat))
+    called = min(timeit.repeat(lambda: [direct(i, nodes) for i in range(items)],
+                               number=1, repeat=repeat))
+
+    per_item = (pushed - called) / items * 1e9
+    return {
+        "nodes": nodes,
+        "items": items,
+        "push_ns_per_item": pushed / items * 1e9,
+        "direct_ns_per_item": called / items * 1e9,
+        "overhead_ns_per_item": per_item,
+        "overhead_ns_per_node": per_item / nodes,
+    }
+
+
+# Items of the suite are (seq, payload) pairs so that the latency of each
+# item can be measured from the moment the pipeline pulls it. Node
+# functions are module level to be usable by process pools.
+
+def touch(item):
+    seq, payload = item
+    return seq, payload[::-1]
+
+
+def keep(seq, payload, first):
+    return seq, payload
+
+
+SHARED = Device("bench", 1)
+
+
+def _pipeline(case):
+    nodes = [Node(touch) for _ in range(case["nodes"])]
+    if case.get("contention"):
+        nodes[-1] = Node(touch, dev=SHARED)
+    if case.get("hold"):
+        nodes[0] = Node(touch, hold=True, keyName="first")
+        nodes.append(Node(keep, refer=["first"]))
+    if case.get("nested"):
+        sub = Pipeline([touch] * case["nested"])
+        sub.lock()
+        nodes.append(Node(sub))
+
+    mode = case["mode"]
+    if mode in ("push", "single"):
+        return Pipeline(nodes)
+    executor = ProcessPoolExecutor if mode == "process" else ThreadPoolExecutor
+    return Pipeline(nodes, parallel=True, workers=case["workers"], executor=executor)
+
+
+def _run(p, mode, items, payload):
+    pulled = [0.0] * items
+    latencies = [0.0] * items
+
+    def source():
+        for seq in range(items):
+            pulled[seq] = time.perf_counter()
+            yield seq, payload
+
+    if mode == "push":
+        for item in source():
+            seq, _ = p.push(item)
+            latencies[seq] = time.perf_counter() - pulled[seq]
+    else:
+        for seq, _ in p.iprocess(source()):
+            latencies[seq] = time.perf_counter() - pulled[seq]
+    return latencies
+
+
+def _percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def bench_case(case, items, repeat=3):
+    payload = os.urandom(case["payload"])
+    with _pipeline(case) as p:
+        _run(p, case["mode"], min(items, 100), payload)  # warm up the pool
+        best, latencies = None, None
+        for _ in range(repeat):
+            begin = time.perf_counter()
+            run = _run(p, case["mode"], items, payload)
+            elapsed = time.perf_counter() - begin
+            if best is None or elapsed < best:
+                best, latencies = elapsed, run
+
+        # a separate run, tracemalloc slows the interpreter down; it only
+        # sees this process, not process pool workers
+        tracemalloc.start()
+        _run(p, case["mode"], items, payload)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    latencies.sort()
+    return dict(case,
+                items=items,
+                items_per_sec=items / best,
+                p50_ms=_percentile(latencies, 0.50) * 1e3,
+                p95_ms=_percentile(latencies, 0.95) * 1e3,
+                p99_ms=_percentile(latencies, 0.99) * 1e3,
+                peak_kb=peak / 1024)
+
+
+def suite(workers=4):
+    cases = []
+    for mode in ("push", "single", "thread", "process"):
+        for nodes in (1, 5, 20):
+            cases.append({"mode": mode, "nodes": nodes, "payload": 64})
+        cases.append({"mode": mode, "nodes": 5, "payload": 64 * 1024})
+        cases.append({"mode": mode, "nodes": 5, "payload": 64, "nested": 5})
+        cases.append({"mode": mode, "nodes": 5, "payload": 64, "hold": True})
+    for mode in ("thread", "process"):
+        cases.append({"mode": mode, "nodes": 5, "payload": 64, "contention": True})
+    for case in cases:
+        case["workers"] = workers if case["mode"] in ("thread", "process") else 1
+        case["name"] = "{mode}-n{nodes}-p{payload}".format(**case) + \
+            "".join("-" + k for k in ("nested", "hold", "contention") if case.get(k))
+    return cases
+
+
+def compare(results, baseline, tolerance):
+    # names of the cases whose throughput dropped more than tolerance
+    before = {r["name"]: r for r in baseline["results"]}
+    return [r["name"] for r in results
+            if r["name"] in before and
+            r["items_per_sec"] < before[r["name"]]["items_per_sec"] * (1 - tolerance)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PypeRaptor benchmark suite")
+    parser.add_argument("--items", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--only", default="", help="run the cases whose name contains this")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--baseline", help="results file to compare items/sec against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--overhead", action="store_true",
+                        help="only measure the push overhead per node")
+    args = parser.parse_args(argv)
+
+    if args.overhead:
+        for k, v in bench_push_overhead().items():
+            print("{:>24}: {:.1f}".format(k, v) if isinstance(v, float) else "{:>24}: {}".format(k, v))
+        return 0
+
+    results = []
+    for case in suite(args.workers):
+        if args.only in case["name"]:
+            r = bench_case(case, args.items, args.repeat)
+            results.append(r)
+            print("{name:<36} {items_per_sec:>12.0f} items/s  p50 {p50_ms:8.3f} ms  "
+                  "p99 {p99_ms:8.3f} ms  peak {peak_kb:9.1f} KiB".format(**r))
+
+    with open(args.out, "w") as f:
+        json.dump({"python": sys.version,
+                   "platform": platform.platform(),
+                   "cpus": os.cpu_count(),
+                   "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "results": results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f), args.tolerance)
+        for name in slower:
+            print("regression: {}".format(name))
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,17 @@
 from .pipeline import Pipeline
 from .pipeline import Node
 from .pipeline import Device
+from .pipeline import AsyncDevice
+from .pipeline import PoolDevice
+from .pipeline import RateDevice
+from .pipeline import Branch
+from .pipeline import Failure
+from .cache import NodeCache
+from .cache import SqliteStore
+from .cache import ShelfStore
+from .cache import SingleFlight
+from .metrics import MetricsHook
+from .tracing import Tracer
+from .retry import NodeTimeoutError
+from .checkpoint import Checkpoint
+from .autoscale import Autoscaler
@@ -0,0 +1,150 @@
+from collections import deque
+import logging
+import time
+
+
+class Autoscaler():
+    # Picks how many workers of a parallel pipeline are busy at a time,
+    # between min_workers and max_workers, while process() runs. Every
+    # `interval` seconds it compares the throughput with the previous
+    # interval: it keeps adding workers while that pays off, goes back when
+    # it does not, and removes workers while their time goes to waiting on
+    # Devices. It does not add workers while the mean node latency rises
+    # faster than the throughput: the workers it has are already queueing
+    # on something. Steps are a quarter of the workers (at least one), so that
+    # their effect shows over the noise. Each decision is logged to the
+    # "Pipeline" logger and kept in `decisions`.
+    def __init__(self, min_workers: int = 1, max_workers: int = 8, interval: float = 0.5,
+                 tolerance: float = 0.05, wait_ratio: float = 0.5, settle: int = 3,
+                 history: int = 1000):
+        assert type(min_workers) == int and min_workers > 0, \
+            Exception("min_workers must be a positive integer")
+        assert type(max_workers) == int and max_workers >= min_workers, \
+            Exception("max_workers must be an integer not below min_workers")
+        assert interval > 0, Exception("Autoscaler interval must be a positive number of seconds")
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.tolerance = tolerance
+        self.wait_ratio = wait_ratio
+        self.settle = settle
+        self.history = history
+        self.workers = min_workers
+        self.decisions = deque(maxlen=history)
+        self.begin([])
+
+    def __repr__(self):
+        return "Autoscaler(workers: {}, min: {}, max: {})".format(
+            self.workers, self.min_workers, self.max_workers)
+
+    def begin(self, windows: list, metrics=None):
+        # windows: the live list of windows of a run, filled as it starts
+        self.__windows__ = windows
+        self.__metrics__ = metrics
+        self.__pulled__ = 0
+        self.__since__ = time.perf_counter()
+        self.__totals__ = self.__node_totals()
+        self.__throughput__ = None
+        self.__latency__ = None
+        self.__last__ = "up"
+        self.__previous__ = self.workers
+        self.__holds__ = 0
+
+    def track(self, source):
+        # counts the items a run takes from its source and decides as they go
+        self.__apply()
+        for i in source:
+            self.__pulled__ += 1
+            if time.perf_counter() - self.__since__ >= self.interval:
+                self.decide()
+            yield i
+
+    def decide(self):
+        now = time.perf_counter()
+        throughput = self.__pulled__ / (now - self.__since__)
+        totals = self.__node_totals()
+        calls, total, wait = (b - a for a, b in zip(self.__totals__, totals))
+        latency = total / calls if calls else 0.0
+        device_wait = wait / total if total else 0.0
+        self.__pulled__, self.__since__, self.__totals__ = 0, now, totals
+
+        action, reason = self.__choose(throughput, latency, device_wait)
+        before = self.workers
+        if action == "up" and self.workers >= self.max_workers:
+            action, reason = "hold", "at max_workers, " + reason
+        elif action == "down" and self.workers <= self.min_workers:
+            action, reason = "hold", "at min_workers, " + reason
+        self.workers, self.__previous__ = self.__step(action), self.workers
+        if action != "hold":
+            self.__holds__ = 0
+        self.__last__ = action
+        self.__throughput__ = throughput
+        self.__latency__ = latency
+        self.__apply()
+
+        decision = {"time": time.time(), "from": before, "workers": self.workers,
+                    "action": action, "reason": reason, "throughput": throughput,
+                    "latency": latency, "device_wait": device_wait}
+        self.decisions.append(decision)
+        logging.getLogger("Pipeline").info(
+            "autoscale %s %d -> %d workers: %s (%.1f items/s, latency %.2f ms, device wait %.0f%%)",
+            action, before, self.workers, reason, throughput, latency * 1e3, device_wait * 100)
+        return decision
+
+    def __choose(self, throughput, latency, device_wait):
+        self.__reverting__ = False
+        if self.__throughput__ is None:
+            return "up", "first interval"
+        gain = throughput / self.__throughput__ - 1 if self.__throughput__ else 0.0
+        slower = latency / self.__latency__ - 1 if self.__latency__ else 0.0
+        change = "throughput {:+.0%}, latency {:+.0%}".format(gain, slower)
+        if device_wait > self.wait_ratio:
+            return "down", "workers wait on Devices, " + change
+        queueing = slower > gain + self.tolerance
+        if self.__last__ == "up":
+            if gain > self.tolerance and queueing:
+                return "hold", "latency outgrows throughput, " + change
+            if gain > self.tolerance:
+                return "up", change
+            # the added workers did not pay off: back, and stay there a while
+            self.__reverting__ = True
+            return "down", "no gain, " + change
+        if self.__last__ == "down" and gain < -self.tolerance:
+            self.__reverting__ = True
+            return "up", "the removed workers were needed, " + change
+        self.__holds__ += 1
+        if self.__holds__ > self.settle and not queueing:
+            return "up", "probing, " + change
+        return "hold", change
+
+    def __step(self, action):
+        if action == "hold":
+            return self.workers
+        if self.__reverting__:
+            # back to where the last step started
+            return self.__previous__
+        step = max(1, self.workers // 4)
+        if action == "up":
+            return min(self.max_workers, self.workers + step)
+        return max(self.min_workers, self.workers - step)
+
+    def __apply(self):
+        for window in self.__windows__:
+            window.window = self.workers
+
+    def __node_totals(self):
+        metrics = self.__metrics__
+        if metrics is None:
+            return (0, 0.0, 0.0)
+        stats = list(metrics.nodes.values())
+        return (sum(s.calls for s in stats),
+                sum(s.total_time for s in stats),
+                sum(s.wait_time for s in stats))
+
+    def __getstate__(self):
+        # copies and worker processes start from min_workers
+        return {k: getattr(self, k) for k in ("min_workers", "max_workers", "interval",
+                                              "tolerance", "wait_ratio", "settle", "history")}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
@@ -0,0 +1,93 @@
+from typing import Callable
+import threading
+
+
+class MicroBatch():
+    # Buffer of a sink Node: items are added by any number of workers and
+    # handed to fn in one bulk call when `size` items are buffered, when
+    # the oldest one has waited `linger` seconds, or on flush(). Bulk calls
+    # never overlap and keep the order in which batches were closed.
+    def __init__(self, fn: Callable, size: int = None, linger: float = None, node=None):
+        self.fn = fn
+        self.size = size
+        self.linger = linger
+        self.node = node
+        self.flushes = 0
+        self.__lock__ = threading.Lock()
+        self.__write__ = threading.Lock()
+        self.__buffer__ = []
+        self.__timer__ = None
+        self.__error__ = None
+
+    def __repr__(self):
+        return "MicroBatch(size: {}, linger: {}, buffered: {}, flushes: {})".format(
+            self.size, self.linger, len(self.__buffer__), self.flushes)
+
+    def __len__(self):
+        return len(self.__buffer__)
+
+    def add(self, item):
+        self.__raise()
+        with self.__lock__:
+            self.__buffer__.append(item)
+            full = self.size is not None and len(self.__buffer__) >= self.size
+            if not full and self.linger is not None and self.__timer__ is None:
+                self.__timer__ = threading.Timer(self.linger, self.__expire)
+                self.__timer__.daemon = True
+                self.__timer__.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.__write__:
+            with self.__lock__:
+                batch, self.__buffer__ = self.__buffer__, []
+                timer, self.__timer__ = self.__timer__, None
+            if timer is not None:
+                timer.cancel()
+            # workers keep adding while a batch is written
+            step = self.size or max(len(batch), 1)
+            for k in range(0, len(batch), step):
+                self.__write(batch[k:k + step])
+        self.__raise()
+
+    def restore(self, items):
+        # replaces the buffer with items saved by a checkpoint
+        with self.__write__:
+            with self.__lock__:
+                self.__buffer__ = list(items)
+
+    def pending(self):
+        # the items not written yet, the batch being written included
+        with self.__write__:
+            with self.__lock__:
+                return list(self.__buffer__)
+
+    def __write(self, batch):
+        if self.node is not None:
+            self.node.obtain_device()
+        try:
+            self.fn(batch)
+            self.flushes += 1
+        finally:
+            if self.node is not None:
+                self.node.return_device()
+
+    def __expire(self):
+        try:
+            self.flush()
+        except Exception as e:
+            # raised to the next worker adding an item, or to flush()
+            self.__error__ = e
+
+    def __raise(self):
+        error, self.__error__ = self.__error__, None
+        if error is not None:
+            raise error
+
+    def __getstate__(self):
+        # copies and worker processes start with an empty buffer
+        return {"fn": self.fn, "size": self.size, "linger": self.linger, "node": self.node}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
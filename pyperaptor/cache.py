@@ -0,0 +1,273 @@
+from collections import OrderedDict
+from typing import Callable
+import threading
+import pickle
+import sqlite3
+import shelve
+import time
+import asyncio
+
+
+_MISSING = object()
+
+
+class SqliteStore():
+    # Persistent backing for NodeCache in a SQLite file. Keys and values
+    # are pickled, so they must be picklable.
+    def __init__(self, path: str, table: str = "pyperaptor_cache"):
+        self.path = path
+        self.table = table
+        self.__lock__ = threading.Lock()
+        self.__db__ = None
+
+    def __connection(self):
+        if self.__db__ is None:
+            self.__db__ = sqlite3.connect(self.path, check_same_thread=False)
+            self.__db__.execute(
+                "CREATE TABLE IF NOT EXISTS {} (key BLOB PRIMARY KEY, value BLOB)".format(self.table))
+        return self.__db__
+
+    def get(self, key):
+        with self.__lock__:
+            row = self.__connection().execute(
+                "SELECT value FROM {} WHERE key = ?".format(self.table),
+                (pickle.dumps(key),)).fetchone()
+        return _MISSING if row is None else pickle.loads(row[0])
+
+    def put(self, key, value):
+        with self.__lock__:
+            db = self.__connection()
+            db.execute(
+                "INSERT OR REPLACE INTO {} (key, value) VALUES (?, ?)".format(self.table),
+                (pickle.dumps(key), pickle.dumps(value)))
+            db.commit()
+
+    def delete(self, key):
+        with self.__lock__:
+            db = self.__connection()
+            db.execute("DELETE FROM {} WHERE key = ?".format(self.table), (pickle.dumps(key),))
+            db.commit()
+
+    def close(self):
+        with self.__lock__:
+            if self.__db__ is not None:
+                self.__db__.close()
+                self.__db__ = None
+
+    def __getstate__(self):
+        return {"path": self.path, "table": self.table}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["table"])
+
+
+class ShelfStore():
+    # Persistent backing for NodeCache in a shelve file.
+    def __init__(self, path: str):
+        self.path = path
+        self.__lock__ = threading.Lock()
+        self.__shelf__ = None
+
+    def __shelf(self):
+        if self.__shelf__ is None:
+            self.__shelf__ = shelve.open(self.path)
+        return self.__shelf__
+
+    def get(self, key):
+        with self.__lock__:
+            return self.__shelf().get(repr(key), _MISSING)
+
+    def put(self, key, value):
+        with self.__lock__:
+            self.__shelf()[repr(key)] = value
+            self.__shelf__.sync()
+
+    def delete(self, key):
+        with self.__lock__:
+            self.__shelf().pop(repr(key), None)
+
+    def close(self):
+        with self.__lock__:
+            if self.__shelf__ is not None:
+                self.__shelf__.close()
+                self.__shelf__ = None
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+
+class NodeCache():
+    # Thread safe LRU cache of node results, with optional time to live and
+    # an optional persistent store consulted on memory misses.
+    def __init__(self,
+                 maxsize: int = 1024,
+                 ttl: float = None,
+                 key: Callable = None,
+                 store=None):
+        assert maxsize > 0, Exception("NodeCache maxsize must be positive")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.key = key
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__lock__ = threading.Lock()
+        self.__entries__ = OrderedDict()
+
+    def __repr__(self):
+        return "NodeCache(maxsize: {}, ttl: {}, hits: {}, misses: {}, evictions: {})".format(
+            self.maxsize, self.ttl, self.hits, self.misses, self.evictions)
+
+    def make_key(self, i):
+        return i if self.key is None else self.key(i)
+
+    def get(self, k):
+        now = time.monotonic()
+        with self.__lock__:
+            entry = self.__entries__.get(k, _MISSING)
+            if entry is not _MISSING:
+                value, expires = entry
+                if expires is None or expires > now:
+                    self.__entries__.move_to_end(k)
+                    self.hits += 1
+                    return value
+                del self.__entries__[k]
+                self.evictions += 1
+
+        if self.store is not None:
+            entry = self.store.get(k)
+            if entry is not _MISSING:
+                value, expires = entry
+                if expires is None or expires > time.time():
+                    self.__remember(k, value)
+                    with self.__lock__:
+                        self.hits += 1
+                    return value
+                self.store.delete(k)
+
+        with self.__lock__:
+            self.misses += 1
+        return _MISSING
+
+    def put(self, k, value):
+        self.__remember(k, value)
+        if self.store is not None:
+            expires = None if self.ttl is None else time.time() + self.ttl
+            self.store.put(k, (value, expires))
+
+    def __remember(self, k, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self.__lock__:
+            self.__entries__[k] = (value, expires)
+            self.__entries__.move_to_end(k)
+            while len(self.__entries__) > self.maxsize:
+                self.__entries__.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.__lock__:
+            self.__entries__.clear()
+
+    def __len__(self):
+        return len(self.__entries__)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "size": len(self.__entries__)}
+
+    def __getstate__(self):
+        # copies and worker processes start with an empty memory cache
+        state = self.__dict__.copy()
+        del state["__lock__"]
+        state["__entries__"] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock__ = threading.Lock()
+
+
+class _Flight():
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight():
+    # Coalesces concurrent calls with the same key: the first caller runs
+    # the call, the others wait for it and share its result (or exception).
+    def __init__(self, key: Callable = None):
+        self.key = key
+        self.shared = 0
+        self.__lock__ = threading.Lock()
+        self.__flights__ = {}
+        self.__aflights__ = {}
+
+    def __repr__(self):
+        return "SingleFlight(in flight: {}, shared: {})".format(
+            len(self.__flights__) + len(self.__aflights__), self.shared)
+
+    def make_key(self, i):
+        return i if self.key is None else self.key(i)
+
+    def do(self, k, fn: Callable):
+        with self.__lock__:
+            flight = self.__flights__.get(k)
+            leader = flight is None
+            if leader:
+                flight = self.__flights__[k] = _Flight()
+            else:
+                self.shared += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = fn()
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.__lock__:
+                del self.__flights__[k]
+            flight.done.set()
+
+    async def ado(self, k, fn: Callable):
+        # fn returns an awaitable; only used from the event loop thread
+        future = self.__aflights__.get(k)
+        if future is not None:
+            self.shared += 1
+            return await asyncio.shield(future)
+
+        future = self.__aflights__[k] = asyncio.get_event_loop().create_future()
+        try:
+            value = await fn()
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # the waiters get it; do not warn about an unretrieved exception
+            future.exception()
+            raise
+        finally:
+            del self.__aflights__[k]
+
+    def __getstate__(self):
+        return {"key": self.key}
+
+    def __setstate__(self, state):
+        self.__init__(state["key"])
@@ -0,0 +1,94 @@
+import threading
+import pickle
+import os
+
+
+class Checkpoint():
+    # Progress of a process() run over its source, saved to `path` every
+    # `every` finished inputs and when the run ends. The saved offset is a
+    # low watermark: every input before it has gone through the pipeline,
+    # whatever order they finished in. Items the sink nodes still buffer
+    # are saved with it, so resuming from it processes each input at least
+    # once.
+    def __init__(self, path: str, every: int = 1000):
+        assert type(every) == int and every > 0, Exception("Checkpoint every must be a positive integer")
+        self.path = path
+        self.every = every
+        self.saves = 0
+        self.__lock__ = threading.Lock()
+        self.begin(0)
+
+    def __repr__(self):
+        return "Checkpoint(path: {}, offset: {}, pending: {})".format(
+            self.path, self.watermark(), len(self.__pending__))
+
+    def begin(self, offset: int):
+        with self.__lock__:
+            self.__offset__ = offset
+            self.__pending__ = {}
+            self.__finished__ = 0
+
+    def pull(self):
+        # the offset of the next input taken from the source
+        with self.__lock__:
+            k = self.__offset__
+            self.__offset__ += 1
+            self.__pending__[k] = 1
+        return k
+
+    def add(self, k: int):
+        # input k has one more item in the pipeline (a flatmap output)
+        with self.__lock__:
+            self.__pending__[k] += 1
+
+    def done(self, k: int):
+        with self.__lock__:
+            left = self.__pending__[k] - 1
+            if left:
+                self.__pending__[k] = left
+            else:
+                del self.__pending__[k]
+                self.__finished__ += 1
+
+    def due(self):
+        return self.__finished__ >= self.every
+
+    def watermark(self):
+        with self.__lock__:
+            # pending offsets are added in increasing order
+            return next(iter(self.__pending__), self.__offset__)
+
+    def save(self, sinks=()):
+        # the watermark is taken before the buffers: items before it were
+        # either written or are in a buffer by then
+        offset = self.watermark()
+        state = {"offset": offset, "batches": [sink.pending() for sink in sinks]}
+        tmp = "{}.tmp".format(self.path)
+        with open(tmp, "wb") as f:
+            pickle.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        with self.__lock__:
+            self.__finished__ = 0
+        self.saves += 1
+        return offset
+
+    @staticmethod
+    def read(path):
+        # (offset, batches) saved at path; an int is an offset to resume from
+        # and a path with nothing saved yet starts from the beginning
+        if isinstance(path, int):
+            return path, []
+        try:
+            with open(path, "rb") as f:
+                state = pickle.load(f)
+        except FileNotFoundError:
+            return 0, []
+        return state["offset"], state["batches"]
+
+    def __getstate__(self):
+        return {"path": self.path, "every": self.every}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
@@ -0,0 +1,107 @@
+from collections import deque
+import threading
+
+
+class MetricsHook():
+    # Receives every node call of a Pipeline with metrics enabled, e.g. to
+    # export them to a metrics system. Times are in seconds; latency
+    # includes the wait for the node Device. In process pool mode hooks
+    # run inside the worker processes.
+    def on_call(self, node: str, latency: float, wait: float, error: bool):
+        pass
+
+
+class NodeStats():
+    # Counters of a node and a sliding window of its most recent latencies.
+    def __init__(self, name: str, samples: int = 1024):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.wait_time = 0.0
+        self.__lock__ = threading.Lock()
+        self.__latencies__ = deque(maxlen=samples)
+
+    def __repr__(self):
+        return "NodeStats(name: {}, calls: {}, errors: {})".format(
+            self.name, self.calls, self.errors)
+
+    def record(self, latency: float, wait: float, error: bool):
+        with self.__lock__:
+            self.calls += 1
+            self.errors += error
+            self.total_time += latency
+            self.wait_time += wait
+            self.__latencies__.append(latency)
+
+    def percentile(self, q: float):
+        with self.__lock__:
+            latencies = sorted(self.__latencies__)
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def snapshot(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "p50": self.percentile(0.50),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "device_wait": self.wait_time,
+            "executing": self.total_time - self.wait_time,
+        }
+
+    def drain(self):
+        # hands the counters over (to the parent of a worker process)
+        with self.__lock__:
+            counters = (self.calls, self.errors, self.total_time, self.wait_time,
+                        list(self.__latencies__))
+            self.calls = self.errors = 0
+            self.total_time = self.wait_time = 0.0
+            self.__latencies__.clear()
+        return counters
+
+    def merge(self, counters):
+        calls, errors, total_time, wait_time, latencies = counters
+        with self.__lock__:
+            self.calls += calls
+            self.errors += errors
+            self.total_time += total_time
+            self.wait_time += wait_time
+            self.__latencies__.extend(latencies)
+
+
+class Metrics():
+    # Per node stats of one Pipeline, keyed by node name.
+    def __init__(self, hooks: list = (), samples: int = 1024):
+        assert samples > 0, Exception("metrics samples must be a positive number")
+        self.hooks = list(hooks)
+        self.samples = samples
+        self.nodes = {}
+
+    def node(self, name: str):
+        if name not in self.nodes:
+            self.nodes[name] = NodeStats(name, self.samples)
+        return self.nodes[name]
+
+    def add_hook(self, hook: MetricsHook):
+        self.hooks.append(hook)
+
+    def reset(self):
+        for stats in self.nodes.values():
+            stats.drain()
+
+    def drain(self):
+        return {name: stats.drain() for name, stats in self.nodes.items()}
+
+    def merge(self, drained):
+        for name, counters in drained.items():
+            self.node(name).merge(counters)
+
+    def __getstate__(self):
+        # copies and worker processes start counting from zero
+        return {"hooks": self.hooks, "samples": self.samples}
+
+    def __setstate__(self, state):
+        self.__init__(state["hooks"], state["samples"])
@@ -3,15 +3,34 @@ from types import FunctionType
 import types
 import logging
 import copy
+import inspect
+import traceback
 
 import concurrent
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from threading import BoundedSemaphore
+import threading
+import queue
+import asyncio
+import itertools
+import multiprocessing
+import pickle
+import io
+import time
 from collections.abc import Iterable
+from collections import deque
 import functools
+import weakref
 
 from functools import partial
 
+from .cache import NodeCache, SingleFlight, _MISSING
+from .metrics import Metrics
+from .batching import MicroBatch
+from .retry import Retry
+from .checkpoint import Checkpoint
+from .autoscale import Autoscaler
+
 
 class PipelineNodeError(Exception):
     pass
@@ -21,19 +40,1414 @@ class InvalidNodeOperation(Exception):
     pass
 
 
+_POSITIONAL = (inspect.Parameter.POSITIONAL_ONLY,
+               inspect.Parameter.POSITIONAL_OR_KEYWORD)
+
+
+def _arity(f):
+    code = getattr(f, "__code__", None)
+    if code is not None:
+        return code.co_argcount - 1 if inspect.ismethod(f) else code.co_argcount
+    try:
+        params = inspect.signature(f).parameters.values()
+    except (TypeError, ValueError):
+        return 1
+    return sum(1 for p in params if p.kind in _POSITIONAL)
+
+
+def _takes_positional(f, name):
+    try:
+        param = inspect.signature(f).parameters.get(name)
+    except (TypeError, ValueError):
+        return False
+    return param is not None and param.kind in _POSITIONAL
+
+
+def _refer_keys(node):
+    return tuple(k for v in node.get_refer().values()
+                 for k in ([v] if isinstance(v, str) else v))
+
+
+def _adapter(f, argc, refs):
+    # Decide once, at lock time, how a node is called for each kind of input,
+    # so push() does not inspect the callable again for every item.
+    # refs are the item context slots holding the referred values.
+    if not refs:
+        if argc == 0:
+            return lambda i, ctx: f()
+        if argc == 1:
+            return lambda i, ctx: f() if i is None else f(i)
+
+        def call(i, ctx):
+            if i is None:
+                return f()
+            if isinstance(i, tuple):
+                return f(*i)
+            return f(i)
+        return call
+
+    if argc == 0:
+        def call(i, ctx):
+            if i is None:
+                return f()
+            return f(*[ctx[s] for s in refs])
+        return call
+
+    if argc == 1:
+        def call(i, ctx):
+            if i is None:
+                return f()
+            return f(i, *[ctx[s] for s in refs])
+        return call
+
+    def call(i, ctx):
+        if i is None:
+            return f()
+        if isinstance(i, tuple):
+            return f(*i, *[ctx[s] for s in refs])
+        return f(i, *[ctx[s] for s in refs])
+    return call
+
+
+def _with_resource(f, device):
+    # checks a resource out of a PoolDevice for every call and passes it
+    # as the device keyword argument
+    if _is_async(f):
+        async def call(*args):
+            resource = device.checkout()
+            try:
+                return await f(*args, **{device.keyword: resource})
+            finally:
+                device.checkin(resource)
+        return call
+
+    def call(*args):
+        resource = device.checkout()
+        try:
+            return f(*args, **{device.keyword: resource})
+        finally:
+            device.checkin(resource)
+    return call
+
+
+def _pipeline_adapter(pipe):
+    if pipe.is_parallel():
+        def call(i, ctx):
+            if i is None:
+                return pipe.process()
+            return pipe.process(i if isinstance(i, Iterable) else [i])
+        return call
+    return lambda i, ctx: pipe.__run__(i)
+
+
+def _with_device(call, node):
+    def step(i, ctx):
+        node.obtain_device()
+        try:
+            return call(i, ctx)
+        finally:
+            node.return_device()
+    return step
+
+
+def _with_timeout(call, retry):
+    # gives up waiting for a call after retry.timeout seconds; steps outside
+    # of it (the Device one) let go as soon as it times out
+    def step(*args):
+        return retry.timed(call, *args)
+    return step
+
+
+def _with_retry(call, retry):
+    # calls again after an error, outside of the Device so that no slot is
+    # held while backing off
+    def step(*args):
+        attempt = 0
+        while True:
+            try:
+                return call(*args)
+            except Exception:
+                if attempt >= retry.retries:
+                    raise
+                retry.count(retried=1)
+                time.sleep(retry.delay(attempt))
+                attempt += 1
+    return step
+
+
+def _with_flat_retry(call, retry):
+    # outputs handed over cannot be taken back: only the first slice of a
+    # flatmap node is retried
+    retried = _with_retry(call, retry)
+
+    def step(i, ctx):
+        return call(i, ctx) if type(i) is _Expansion else retried(i, ctx)
+    return step
+
+
+def _with_metrics(call, stats, hooks, node=None, tracer=None, name=None):
+    # Times the call for the node stats, hooks and tracer (each optional);
+    # node is given when the step also holds the node Device, so that the
+    # wait for it is told apart from the execution.
+    def step(i, ctx):
+        item = None if tracer is None else i
+        begin = time.perf_counter()
+        if node is not None:
+            node.obtain_device()
+        ready = time.perf_counter()
+        error = True
+        try:
+            i = call(i, ctx)
+            error = False
+            return i
+        finally:
+            if node is not None:
+                node.return_device()
+            end = time.perf_counter()
+            _record(stats, hooks, tracer, name, node, item, begin, ready, end, error)
+    return step
+
+
+def _record(stats, hooks, tracer, name, node, item, begin, ready, end, error):
+    if stats is not None:
+        stats.record(end - begin, ready - begin, error)
+    for hook in hooks:
+        hook.on_call(name, end - begin, ready - begin, error)
+    if tracer is not None:
+        tracer.complete(name, "node", begin, end,
+                        {"item": tracer.label(item), "error": error})
+        if node is not None and node.has_device():
+            device = node.get_device().name
+            tracer.complete("acquire " + device, "device", begin, ready)
+            tracer.complete(device, "device", ready, end)
+
+
+def _sink_adapter(sink):
+    # a micro-batching sink buffers the item and passes it on
+    def call(i, ctx):
+        sink.add(i)
+        return i
+    return call
+
+
+def _branch_call(b):
+    if isinstance(b, Pipeline):
+        return lambda i, ctx: b.__run__(i)
+    if _is_async(b):
+        return _run_coroutine(_adapter(b, _arity(b), ()))
+    return _adapter(b, _arity(b), ())
+
+
+def _steal(future, call, i):
+    # a branch nobody started yet runs in the waiting thread, so branches
+    # never wait for a pool busy with the items that wait for them
+    if future.cancel():
+        return call(i, None)
+    return future.result()
+
+
+def _branch_adapter(branch, pipe):
+    calls = [_branch_call(b) for b in branch.branches]
+
+    def call(i, ctx):
+        pool = pipe.__pool__
+        if pool is None or pipe.is_multiprocess():
+            pool = branch.pool()
+        futures = [pool.submit(c, i, None) for c in calls[1:]]
+        try:
+            outputs = [calls[0](i, None)]
+            outputs.extend(_steal(f, c, i) for f, c in zip(futures, calls[1:]))
+        except BaseException:
+            for f in futures:
+                f.cancel()
+            raise
+        return branch.join(outputs)
+    return call
+
+
+def _async_branch_adapter(branch, pipe):
+    calls = []
+    for b in branch.branches:
+        if isinstance(b, Pipeline):
+            calls.append(functools.partial(lambda b, i, ctx: b.__arun__(i), b))
+        elif _is_async(b):
+            calls.append(_adapter(b, _arity(b), ()))
+        else:
+            calls.append(_offload(_adapter(b, _arity(b), ()), pipe))
+
+    async def call(i, ctx):
+        return branch.join(await asyncio.gather(*[c(i, None) for c in calls]))
+    return call
+
+
+def _with_hold(call, slot):
+    def step(i, ctx):
+        i = call(i, ctx)
+        ctx[slot] = i
+        return i
+    return step
+
+
+def _cache_key(cache, i, ctx, refs):
+    # referred values take part in the key, as the result depends on them.
+    # Unhashable keys give None and are not cached.
+    k = cache.make_key(i)
+    if refs:
+        k = (k, tuple(ctx[s] for s in refs))
+    try:
+        hash(k)
+    except TypeError:
+        return None
+    return k
+
+
+def _cached(cache, k):
+    return _MISSING if k is None else cache.get(k)
+
+
+def _with_cache(call, cache, refs):
+    def step(i, ctx):
+        k = _cache_key(cache, i, ctx, refs)
+        v = _cached(cache, k)
+        if v is _MISSING:
+            v = call(i, ctx)
+            if k is not None:
+                cache.put(k, v)
+        return v
+    return step
+
+
+def _with_batch_cache(call, cache, refs):
+    # only the items missing from the cache reach the batch call
+    def step(items, ctxs):
+        out = [None] * len(items)
+        keys = [_cache_key(cache, i, ctx, refs) for i, ctx in zip(items, ctxs)]
+        missing = []
+        for n, k in enumerate(keys):
+            v = _cached(cache, k)
+            if v is _MISSING:
+                missing.append(n)
+            else:
+                out[n] = v
+        if missing:
+            values = call([items[n] for n in missing], [ctxs[n] for n in missing])
+            for n, v in zip(missing, values):
+                out[n] = v
+                if keys[n] is not None:
+                    cache.put(keys[n], v)
+        return out
+    return step
+
+
+def _coalesce_key(flight, i):
+    # unhashable keys give None and the call is not coalesced
+    k = flight.make_key(i)
+    try:
+        hash(k)
+    except TypeError:
+        return None
+    return k
+
+
+def _with_coalesce(call, flight):
+    def step(i, ctx):
+        k = _coalesce_key(flight, i)
+        if k is None:
+            return call(i, ctx)
+        return flight.do(k, lambda: call(i, ctx))
+    return step
+
+
+def _batch_adapter(f, stack, refs):
+    def call(items, ctxs):
+        if stack:
+            try:
+                import numpy
+            except ImportError:
+                raise PipelineNodeError(
+                    "Node {} stacks its batches and requires numpy".format(f))
+            batch = numpy.stack(items)
+        else:
+            batch = list(items)
+        out = list(f(batch, *[[c[s] for c in ctxs] for s in refs]))
+        if len(out) != len(items):
+            raise PipelineNodeError(
+                "Batch node {} returned {} results for {} items".format(
+                    f, len(out), len(items)))
+        return out
+    return call
+
+
+def _unbatch(call):
+    return lambda i, ctx: call([i], [ctx])[0]
+
+
+def _with_batch_hold(call, slot):
+    def step(items, ctxs):
+        out = call(items, ctxs)
+        for ctx, i in zip(ctxs, out):
+            ctx[slot] = i
+        return out
+    return step
+
+
+# Execution engines move (item, context) pairs between segments and threads.
+def _run_steps(steps, pair):
+    i, ctx = pair
+    for step in steps:
+        i = step(i, ctx)
+    return i, ctx
+
+
+def _run_batch(call, pairs):
+    ctxs = [ctx for _, ctx in pairs]
+    return list(zip(call([i for i, _ in pairs], ctxs), ctxs))
+
+
+# A filter node turns the items it rejects into _DROP. Segments holding a
+# filter run with the _filtered runners, which stop at _DROP, and dropped
+# items are taken out of the stream between segments.
+_DROP = object()
+
+# the size of a flatmap segment, whose fn returns a slice of pairs and
+# the call taking the next one
+_FLAT = object()
+
+# Flatmap outputs are taken in slices of 1, 2, 4... up to _SLICE outputs,
+# each one a call of the node: it holds the node Device, is timed and
+# counts in its metrics like any other call.
+_SLICE = 1024
+
+
+def _filter_adapter(call):
+    def step(i, ctx):
+        return i if call(i, ctx) else _DROP
+    return step
+
+
+def _async_filter_adapter(call):
+    async def step(i, ctx):
+        return i if await call(i, ctx) else _DROP
+    return step
+
+
+def _run_filtered(steps, pair):
+    i, ctx = pair
+    if i is _DROP:
+        return pair
+    for step in steps:
+        i = step(i, ctx)
+        if i is _DROP:
+            break
+    return i, ctx
+
+
+async def _arun_filtered(steps, pair):
+    i, ctx = pair
+    if i is _DROP:
+        return pair
+    for step in steps:
+        i = await step(i, ctx)
+        if i is _DROP:
+            break
+    return i, ctx
+
+
+def _run_filtered_batch(call, pairs):
+    # batch stages of staged pipelines keep dropped items in their place
+    kept = [p for p in pairs if p[0] is not _DROP]
+    out = iter(_run_batch(call, kept) if kept else ())
+    return [p if p[0] is _DROP else next(out) for p in pairs]
+
+
+class _Expansion():
+    # the outputs a flatmap node has yet to give for item
+    __slots__ = ("item", "outputs", "size")
+
+    def __init__(self, item, outputs):
+        self.item = item
+        self.outputs = iter(outputs)
+        self.size = 1
+
+    def __repr__(self):
+        return "Expansion(item: {!r})".format(self.item)
+
+
+def _flat_adapter(call):
+    # the first call on an item starts its outputs, calls on the _Expansion
+    # it returns take the next slices; (outputs, None) is the last slice
+    def step(i, ctx):
+        if type(i) is not _Expansion:
+            i = _Expansion(i, call(i, ctx))
+        outputs = list(itertools.islice(i.outputs, i.size))
+        if len(outputs) < i.size:
+            return outputs, None
+        i.size = min(2 * i.size, _SLICE)
+        return outputs, i
+    return step
+
+
+def _run_flat(call, pair):
+    # every output of a flatmap node continues with its own copy of the
+    # item context; the outputs are taken as they are consumed
+    i, ctx = pair
+    if i is _DROP:
+        return (), None
+    return _flat_slice(call, i, ctx)
+
+
+def _flat_slice(call, i, ctx):
+    outputs, rest = call(i, ctx)
+    pairs = [(o, None if ctx is None else list(ctx)) for o in outputs]
+    return pairs, None if rest is None else functools.partial(_flat_slice, call, rest, ctx)
+
+
+def _run_counted_flat(ledger, call, pair):
+    # _run_flat for checkpointed runs: the input, whose offset ends its
+    # context, is done once its last output is out
+    i, ctx = pair
+    if i is _DROP:
+        ledger.done(ctx[-1])
+        return (), None
+    return _counted_slice(ledger, call, i, ctx)
+
+
+def _counted_slice(ledger, call, i, ctx):
+    outputs, rest = call(i, ctx)
+    for _ in outputs:
+        ledger.add(ctx[-1])
+    if rest is None:
+        ledger.done(ctx[-1])
+        return [(o, list(ctx)) for o in outputs], None
+    return ([(o, list(ctx)) for o in outputs],
+            functools.partial(_counted_slice, ledger, call, rest, ctx))
+
+
+def _expanded(slices, run=None):
+    # the outputs of flatmap runners; run takes the later slices (on a
+    # worker), by default they are taken right here
+    for pairs, more in slices:
+        yield from pairs
+        while more is not None:
+            pairs, more = more() if run is None else run(more)
+            yield from pairs
+
+
+async def _aexpanded(slices, pipe):
+    async for pairs, more in slices:
+        for p in pairs:
+            yield p
+        while more is not None:
+            pairs, more = await _offload(more, pipe)()
+            for p in pairs:
+                yield p
+
+
+class Failure():
+    # An item a node raised on, kept by pipelines capturing their errors:
+    # the node name, its input, the exception, the formatted traceback and
+    # the source item it came from, to process again.
+    __slots__ = ("node", "item", "error", "traceback", "source")
+
+    def __init__(self, node: str, item, error: Exception, traceback: str, source=None):
+        self.node = node
+        self.item = item
+        self.error = error
+        self.traceback = traceback
+        self.source = source
+
+    def __repr__(self):
+        return "Failure(node: {}, item: {!r}, source: {!r}, error: {!r})".format(
+            self.node, self.item, self.source, self.error)
+
+    def __getstate__(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+
+def _with_capture(call, name, capture, slot):
+    # slot: the context slot holding the source item
+    def step(i, ctx):
+        try:
+            return call(i, ctx)
+        except Exception as e:
+            capture(Failure(name, i, e, traceback.format_exc(), ctx[slot]))
+            return _DROP
+    return step
+
+
+def _with_async_capture(call, name, capture, slot):
+    async def step(i, ctx):
+        try:
+            return await call(i, ctx)
+        except Exception as e:
+            capture(Failure(name, i, e, traceback.format_exc(), ctx[slot]))
+            return _DROP
+    return step
+
+
+def _with_batch_capture(call, name, capture, slot):
+    # a failed batch fails every item in it
+    def step(items, ctxs):
+        try:
+            return call(items, ctxs)
+        except Exception as e:
+            trace = traceback.format_exc()
+            for i, ctx in zip(items, ctxs):
+                capture(Failure(name, i, e, trace, ctx[slot]))
+            return [_DROP] * len(items)
+    return step
+
+
+def _with_flat_capture(call, name, capture, slot):
+    # a failed slice ends the outputs of its item
+    def step(i, ctx):
+        try:
+            return call(i, ctx)
+        except Exception as e:
+            item = i.item if type(i) is _Expansion else i
+            capture(Failure(name, item, e, traceback.format_exc(), ctx[slot]))
+            return (), None
+    return step
+
+
+def _kept(pairs):
+    return (p for p in pairs if p[0] is not _DROP)
+
+
+async def _akept(pairs):
+    async for p in pairs:
+        if p[0] is not _DROP:
+            yield p
+
+
+async def _arun_steps(steps, pair):
+    i, ctx = pair
+    for step in steps:
+        i = await step(i, ctx)
+    return i, ctx
+
+
+def _values(pairs):
+    for i, _ in pairs:
+        yield i
+
+
+async def _avalues(pairs):
+    async for i, _ in pairs:
+        yield i
+
+
+def _is_async(f):
+    return inspect.iscoroutinefunction(f) or \
+        inspect.iscoroutinefunction(getattr(f, "__call__", None))
+
+
+def _run_coroutine(call):
+    # a coroutine Node reached from push() or a worker thread
+    def step(i, ctx):
+        return asyncio.run(call(i, ctx))
+    return step
+
+
+def _async_pipeline_adapter(pipe):
+    if pipe.is_parallel():
+        async def call(i, ctx):
+            if i is None:
+                return await pipe.aprocess()
+            return await pipe.aprocess(i if isinstance(i, Iterable) else [i])
+        return call
+    return lambda i, ctx: pipe.__arun__(i)
+
+
+def _offload(call, pipe):
+    async def step(*args):
+        loop = asyncio.get_event_loop()
+        pool = None if pipe.is_multiprocess() else pipe.__pool__
+        return await loop.run_in_executor(pool, call, *args)
+    return step
+
+
+def _with_async_device(call, node):
+    async def step(i, ctx):
+        await node.aobtain_device()
+        try:
+            return await call(i, ctx)
+        finally:
+            node.return_device()
+    return step
+
+
+def _with_async_timeout(call, retry):
+    async def step(*args):
+        return await retry.atimed(call, *args)
+    return step
+
+
+def _with_async_retry(call, retry):
+    async def step(*args):
+        attempt = 0
+        while True:
+            try:
+                return await call(*args)
+            except Exception:
+                if attempt >= retry.retries:
+                    raise
+                retry.count(retried=1)
+                await asyncio.sleep(retry.delay(attempt))
+                attempt += 1
+    return step
+
+
+def _with_async_metrics(call, stats, hooks, node=None, tracer=None, name=None):
+    async def step(i, ctx):
+        item = None if tracer is None else i
+        begin = time.perf_counter()
+        if node is not None:
+            await node.aobtain_device()
+        ready = time.perf_counter()
+        error = True
+        try:
+            i = await call(i, ctx)
+            error = False
+            return i
+        finally:
+            if node is not None:
+                node.return_device()
+            end = time.perf_counter()
+            _record(stats, hooks, tracer, name, node, item, begin, ready, end, error)
+    return step
+
+
+def _with_async_cache(call, cache, refs):
+    async def step(i, ctx):
+        k = _cache_key(cache, i, ctx, refs)
+        v = _cached(cache, k)
+        if v is _MISSING:
+            v = await call(i, ctx)
+            if k is not None:
+                cache.put(k, v)
+        return v
+    return step
+
+
+def _with_async_coalesce(call, flight):
+    async def step(i, ctx):
+        k = _coalesce_key(flight, i)
+        if k is None:
+            return await call(i, ctx)
+        return await flight.ado(k, lambda: call(i, ctx))
+    return step
+
+
+def _with_async_hold(call, slot):
+    async def step(i, ctx):
+        i = await call(i, ctx)
+        ctx[slot] = i
+        return i
+    return step
+
+
+async def _achunks(source, size):
+    chunk = []
+    async for i in source:
+        chunk.append(i)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def _aflatten(chunks):
+    async for chunk in chunks:
+        for i in chunk:
+            yield i
+
+
+async def _aiterate(iterable):
+    if hasattr(iterable, "__aiter__"):
+        async for i in iterable:
+            yield i
+    else:
+        for i in iterable:
+            yield i
+
+
+class _WindowMap():
+    # Maps fn over source on an executor, keeping at most `window` items
+    # submitted but not yet yielded. When ordered, finished results wait in a
+    # reorder buffer until every earlier item was yielded; `peak` records the
+    # deepest that buffer got.
+    # With `steal`, the consuming thread runs queued items itself instead of
+    # blocking on them. Pipelines borrowing a parent's executor need it: their
+    # process() runs on a worker of that same executor and would otherwise
+    # wait on items queued behind it.
+    def __init__(self, executor, fn, source, window, ordered=False, steal=False):
+        self.executor = executor
+        self.fn = fn
+        self.source = source
+        self.window = window
+        self.ordered = ordered
+        self.steal = steal
+        self.peak = 0
+
+    def __iter__(self):
+        if self.ordered:
+            return self.__ordered()
+        return self.__unordered()
+
+    def __submit(self, pending, i, tag):
+        pending[self.executor.submit(self.fn, i)] = (tag, i)
+
+    def __wait(self, pending):
+        if self.steal:
+            for future, (tag, i) in pending.items():
+                if future.cancel():
+                    del pending[future]
+                    stolen = concurrent.futures.Future()
+                    try:
+                        stolen.set_result(self.fn(i))
+                    except Exception as e:
+                        stolen.set_exception(e)
+                    return [(stolen, tag)]
+
+        done, _ = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        return [(future, pending.pop(future)[0]) for future in done]
+
+    def __unordered(self):
+        pending = {}
+        try:
+            for i in self.source:
+                self.__submit(pending, i, None)
+                # a while, the window may shrink as it runs
+                while len(pending) >= self.window:
+                    for future, _ in self.__wait(pending):
+                        yield future.result()
+
+            while pending:
+                for future, _ in self.__wait(pending):
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def __ordered(self):
+        pending = {}
+        buffer = {}
+        submitted = 0
+        released = 0
+        try:
+            for i in self.source:
+                self.__submit(pending, i, submitted)
+                submitted += 1
+                while submitted - released >= self.window:
+                    released = yield from self.__drain(pending, buffer, released)
+
+            while pending or buffer:
+                released = yield from self.__drain(pending, buffer, released)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def __drain(self, pending, buffer, released):
+        if released not in buffer:
+            for future, tag in self.__wait(pending):
+                # fail fast, without waiting for the earlier items
+                if future.exception() is not None:
+                    raise future.exception()
+                buffer[tag] = future
+            self.peak = max(self.peak, len(buffer))
+
+        while released in buffer:
+            future = buffer.pop(released)
+            released += 1
+            yield future.result()
+        return released
+
+
+class _AsyncWindowMap():
+    # Same contract as _WindowMap, with tasks on the running event loop.
+    def __init__(self, fn, source, window, ordered=False):
+        self.fn = fn
+        self.source = source
+        self.window = window
+        self.ordered = ordered
+        self.peak = 0
+
+    def __aiter__(self):
+        if self.ordered:
+            return self.__ordered()
+        return self.__unordered()
+
+    async def __unordered(self):
+        pending = set()
+        try:
+            async for i in self.source:
+                pending.add(asyncio.ensure_future(self.fn(i)))
+                if len(pending) >= self.window:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        yield task.result()
+
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def __ordered(self):
+        pending = {}
+        buffer = {}
+        submitted = 0
+        released = 0
+        try:
+            async for i in self.source:
+                pending[asyncio.ensure_future(self.fn(i))] = submitted
+                submitted += 1
+                while submitted - released >= self.window:
+                    if released not in buffer:
+                        await self.__collect(pending, buffer)
+                    while released in buffer:
+                        task = buffer.pop(released)
+                        released += 1
+                        yield task.result()
+
+            while pending or buffer:
+                if released not in buffer:
+                    await self.__collect(pending, buffer)
+                while released in buffer:
+                    task = buffer.pop(released)
+                    released += 1
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def __collect(self, pending, buffer):
+        done, _ = await asyncio.wait(
+            pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
+            buffer[pending.pop(task)] = task
+        self.peak = max(self.peak, len(buffer))
+
+
+# Process pool mode: the locked pipeline is pickled once and loaded by every
+# worker process in _init_worker. Devices are pickled by reference and
+# replaced by their __shared__() stand-in, e.g. a _ProcessDevice backed by a
+# semaphore the workers inherit.
+_WORKER = None
+
+
+class _DevicePickler(pickle.Pickler):
+    def __init__(self, file):
+        super().__init__(file)
+        self.devices = []
+
+    def persistent_id(self, obj):
+        # PoolDevices are pickled by value, each worker keeps its own pool
+        if isinstance(obj, Device) and not isinstance(obj, PoolDevice):
+            for k, d in enumerate(self.devices):
+                if d is obj:
+                    return k
+            self.devices.append(obj)
+            return len(self.devices) - 1
+        return None
+
+
+class _DeviceUnpickler(pickle.Unpickler):
+    def __init__(self, file, devices):
+        super().__init__(file)
+        self.devices = devices
+
+    def persistent_load(self, pid):
+        return self.devices[pid]
+
+
+def _init_worker(payload, devices):
+    global _WORKER
+    _WORKER = _DeviceUnpickler(io.BytesIO(payload), devices).load()
+    # failures go back to the parent, which hands them to the error sink
+    _WORKER.__error_sink__ = None
+
+
+def _run_chunk(chunk, start=0):
+    # the metrics, trace events and retry counters of the worker travel back
+    # with the chunk; sinks write at the end of every chunk
+    offsets, items = chunk
+    results = list(_WORKER.__chain__(items, start))
+    _WORKER.flush()
+    metrics, tracer = _WORKER.__metrics__, _WORKER.__tracer__
+    failures, _WORKER.failures = _WORKER.failures, []
+    return (offsets,
+            results,
+            None if metrics is None else metrics.drain(),
+            None if tracer is None else tracer.drain(),
+            failures,
+            {k: r.drain() for k, r in _WORKER.__retries__()})
+
+
+def _chunks(source, size):
+    it = iter(source)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+_END = object()
+
+
+class _StageLine():
+    # Runs every step of a plan on its own threads (`workers[k]` for step k),
+    # connected by bounded queues, so steps overlap like an assembly line.
+    # Steps are (fn, batch_size); batch steps take whatever is queued, up to
+    # batch_size items, in one call.
+    # At most `window` items are between the feeder and the consumer, which
+    # also bounds the reorder buffer when ordered.
+    def __init__(self, steps, workers, source, queue_size, window, ordered=False):
+        self.steps = steps
+        self.workers = workers
+        self.source = source
+        self.queue_size = queue_size
+        self.window = window
+        self.ordered = ordered
+        self.peak = 0
+
+    def __iter__(self):
+        return self.__run()
+
+    def __run(self):
+        stop = threading.Event()
+        slots = BoundedSemaphore(self.window)
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.steps) + 1)]
+
+        threads = [threading.Thread(
+            target=self.__feed, args=(queues[0], slots, stop), daemon=True)]
+        for k, ((step, size), n) in enumerate(zip(self.steps, self.workers)):
+            remaining = [n, threading.Lock()]
+            for _ in range(n):
+                threads.append(threading.Thread(
+                    target=self.__work,
+                    args=(step, size, queues[k], queues[k + 1], remaining, stop),
+                    daemon=True))
+
+        for t in threads:
+            t.start()
+
+        buffer = {}
+        released = 0
+        try:
+            while True:
+                record = queues[-1].get()
+                if record is _END:
+                    break
+                seq, value, error = record
+                if error is not None:
+                    raise error
+                if not self.ordered:
+                    slots.release()
+                    yield value
+                    continue
+
+                buffer[seq] = value
+                self.peak = max(self.peak, len(buffer))
+                while released in buffer:
+                    value = buffer.pop(released)
+                    released += 1
+                    slots.release()
+                    yield value
+        finally:
+            stop.set()
+
+    def __put(self, q, record, stop):
+        while not stop.is_set():
+            try:
+                q.put(record, timeout=0.05)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __get(self, q, stop):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.05)
+            except queue.Empty:
+                pass
+        return None
+
+    def __feed(self, outbox, slots, stop):
+        seq = 0
+        try:
+            for i in self.source:
+                while not slots.acquire(timeout=0.05):
+                    if stop.is_set():
+                        return
+                if not self.__put(outbox, (seq, i, None), stop):
+                    return
+                seq += 1
+        except Exception as e:
+            self.__put(outbox, (seq, None, e), stop)
+        self.__put(outbox, _END, stop)
+
+    def __gather(self, inbox, size, stop):
+        records = [self.__get(inbox, stop)]
+        while len(records) < size and records[-1] is not None and records[-1] is not _END:
+            try:
+                records.append(inbox.get_nowait())
+            except queue.Empty:
+                break
+        return records
+
+    def __work_batches(self, step, size, inbox, outbox, remaining, stop):
+        while True:
+            records = self.__gather(inbox, size, stop)
+            end = records[-1]
+            if end is None or end is _END:
+                records.pop()
+
+            ok = [r for r in records if r[2] is None]
+            failed = [r for r in records if r[2] is not None]
+            if ok:
+                try:
+                    values = step([r[1] for r in ok])
+                    out = [(r[0], v, None) for r, v in zip(ok, values)]
+                except Exception as e:
+                    out = [(r[0], None, e) for r in ok]
+                failed.extend(out)
+            for record in failed:
+                if not self.__put(outbox, record, stop):
+                    return
+
+            if end is None:
+                return
+            if end is _END:
+                self.__finish(inbox, outbox, remaining, stop)
+                return
+
+    def __finish(self, inbox, outbox, remaining, stop):
+        # leave the marker for the other workers of this stage; the
+        # last one to finish passes it downstream
+        self.__put(inbox, _END, stop)
+        with remaining[1]:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            self.__put(outbox, _END, stop)
+
+    def __work(self, step, size, inbox, outbox, remaining, stop):
+        if size is not None:
+            return self.__work_batches(step, size, inbox, outbox, remaining, stop)
+
+        while True:
+            record = self.__get(inbox, stop)
+            if record is None:
+                return
+            if record is _END:
+                self.__finish(inbox, outbox, remaining, stop)
+                return
+
+            seq, value, error = record
+            if error is None:
+                try:
+                    value = step(value)
+                except Exception as e:
+                    error = e
+            if not self.__put(outbox, (seq, value, error), stop):
+                return
+
+
+async def _aacquire(sem):
+    # Waits for a process semaphore on the event loop. Other processes
+    # release it, so nothing can wake the loop and it is polled.
+    delay = 0.0005
+    while not sem.acquire(False):
+        await asyncio.sleep(delay)
+        delay = min(2 * delay, 0.02)
+
+
 class Device():
     def __init__(self, name: str, number : int = 1):
         self.name = name
         assert number > 0, Exception("Remember Devices are wrappers for BoundedSemaphores. You cannot have less than 1")
         assert type(number) == int, Exception("Device number is quantity, must be integer not %s" % type(number))
+        self.number = number
         self.__sem__ = BoundedSemaphore(number)
+        # (loop, future) of the coroutines waiting in aget(), first come first
+        # served: release() hands its slot straight to the first of them
+        self.__waiters__ = deque()
+        self.__waiters_lock__ = threading.Lock()
 
     def __repr__(self):
         return "name: {}, locked: {}".format(self.name, self.__lock__.locked)
     
     def get(self):
         self.__sem__.acquire()
+
+    async def aget(self):
+        # Waiting on an executor thread could take every thread the node
+        # calls need to release the Device, and a cancelled waiter would
+        # still take a slot later and never give it back.
+        if self.__sem__.acquire(False):
+            return
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        with self.__waiters_lock__:
+            # a release since the first try found no waiter to hand over to
+            if self.__sem__.acquire(False):
+                return
+            self.__waiters__.append((loop, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self.__waiters_lock__:
+                waiting = (loop, future) in self.__waiters__
+                if waiting:
+                    self.__waiters__.remove((loop, future))
+            # a slot handed over to a cancelled future is passed on by
+            # __hand_over, one already taken goes back here
+            if not waiting and future.done() and not future.cancelled():
+                self.release()
+            raise
     
+    def release(self):
+        with self.__waiters_lock__:
+            if not self.__waiters__:
+                self.__sem__.release()
+                return
+            loop, future = self.__waiters__.popleft()
+        try:
+            loop.call_soon_threadsafe(self.__hand_over, future)
+        except RuntimeError:
+            # the loop of the waiter is closed
+            self.release()
+
+    def __hand_over(self, future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+    def __shared__(self):
+        # the stand-in used by process pool workers
+        return _ProcessDevice(self.name, multiprocessing.BoundedSemaphore(self.number))
+
+
+class RateDevice(Device):
+    # Token bucket: its nodes start at most `rate` calls per second, with
+    # bursts of up to `burst` calls. Callers over the rate sleep until their
+    # token is due. With `number`, at most that many calls run at once.
+    def __init__(self, name: str, rate: float, burst: int = 1, number: int = None):
+        assert rate > 0, Exception("RateDevice rate must be a positive number of calls per second")
+        assert type(burst) == int and burst > 0, Exception("RateDevice burst must be a positive integer")
+        super().__init__(name, number or 1)
+        self.rate = rate
+        self.burst = burst
+        self.limited = number is not None
+        self.throttled = 0.0
+        # [tokens, time of the last update]; tokens go negative as calls
+        # reserve the tokens still to come
+        self.__bucket__ = [float(burst), time.monotonic()]
+        self.__bucket_lock__ = threading.Lock()
+
+    def __repr__(self):
+        return "RateDevice(name: {}, rate: {}, burst: {}, delay: {:.3f})".format(
+            self.name, self.rate, self.burst, self.delay())
+
+    def __reserve(self):
+        with self.__bucket_lock__:
+            now = time.monotonic()
+            tokens, stamp = self.__bucket__[0], self.__bucket__[1]
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate) - 1
+            self.__bucket__[0], self.__bucket__[1] = tokens, now
+            wait = 0.0 if tokens >= 0 else -tokens / self.rate
+            self.throttled += wait
+        return wait
+
+    def delay(self):
+        # how long a call started now would wait for its token
+        with self.__bucket_lock__:
+            tokens, stamp = self.__bucket__[0], self.__bucket__[1]
+            tokens = min(self.burst, tokens + (time.monotonic() - stamp) * self.rate)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def get(self):
+        wait = self.__reserve()
+        if wait > 0:
+            time.sleep(wait)
+        if self.limited:
+            super().get()
+
+    async def aget(self):
+        wait = self.__reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        if self.limited:
+            await super().aget()
+
+    def release(self):
+        if self.limited:
+            super().release()
+
+    def __shared__(self):
+        # workers of a process pool share one bucket
+        shared = copy.copy(self)
+        shared.__bucket__ = multiprocessing.Array("d", self.__bucket__)
+        shared.__bucket_lock__ = shared.__bucket__.get_lock()
+        shared.__sem__ = multiprocessing.BoundedSemaphore(self.number)
+        shared.__waiters__ = deque()
+        shared.__waiters_lock__ = threading.Lock()
+        return shared
+
+
+class AsyncDevice(Device):
+    # Device backed by an asyncio semaphore, for Nodes run by aprocess().
+    # Semaphores are bound to an event loop: each loop using the Device
+    # gets its own.
+    def __init__(self, name: str, number: int = 1):
+        super().__init__(name, number)
+        self.__asems__ = weakref.WeakKeyDictionary()
+
+    def __semaphore(self):
+        loop = asyncio.get_event_loop()
+        sem = self.__asems__.get(loop)
+        if sem is None:
+            sem = self.__asems__[loop] = asyncio.BoundedSemaphore(self.number)
+        return sem
+
+    def get(self):
+        raise PipelineNodeError(
+            "AsyncDevice {} can only be obtained from aprocess()/apush()".format(self.name))
+
+    async def aget(self):
+        await self.__semaphore().acquire()
+
+    def release(self):
+        self.__semaphore().release()
+
+class PoolDevice(Device):
+    # Device handing out resource instances (connections, GPU contexts,
+    # file handles...). Nodes using it receive a checked out resource as
+    # the `keyword` argument on every call; at most `number` are in use.
+    # Resources come from `resources` and are created lazily by `factory`.
+    # Idle ones are dropped after `max_idle` seconds (only with a factory,
+    # to create them again) or when `check` fails.
+    def __init__(self,
+                 name: str,
+                 factory: Callable = None,
+                 resources: list = None,
+                 number: int = None,
+                 keyword: str = "resource",
+                 check: Callable = None,
+                 max_idle: float = None,
+                 close: Callable = None):
+        resources = list(resources or ())
+        assert factory is not None or resources, \
+            PipelineNodeError("PoolDevice {} needs a factory or resources".format(name))
+        # without a factory, resources dropped or missing cannot be replaced
+        assert factory is not None or number is None or number <= len(resources), \
+            PipelineNodeError("PoolDevice {} has {} resources for {} at once and no factory".format(
+                name, len(resources), number))
+        assert factory is not None or max_idle is None, \
+            PipelineNodeError("PoolDevice {} needs a factory to drop idle resources".format(name))
+        super().__init__(name, number or max(len(resources), 1))
+        self.factory = factory
+        self.keyword = keyword
+        self.check = check
+        self.max_idle = max_idle
+        self.close = close
+        self.created = 0
+        self.discarded = 0
+        self.__pool_lock__ = threading.Lock()
+        now = time.monotonic()
+        self.__idle__ = deque((r, now) for r in resources)
+
+    def __repr__(self):
+        return "PoolDevice(name: {}, number: {}, idle: {}, created: {}, discarded: {})".format(
+            self.name, self.number, len(self.__idle__), self.created, self.discarded)
+
+    def checkout(self):
+        while True:
+            with self.__pool_lock__:
+                # the most recently used resource is the likeliest to be alive
+                resource, since = self.__idle__.pop() if self.__idle__ else (_MISSING, None)
+            if resource is _MISSING:
+                if self.factory is None:
+                    raise PipelineNodeError(
+                        "PoolDevice {} has no healthy resource left".format(self.name))
+                resource = self.factory()
+                with self.__pool_lock__:
+                    self.created += 1
+                return resource
+            if self.max_idle is not None and time.monotonic() - since > self.max_idle:
+                self.discard(resource)
+            elif self.check is not None and not self.check(resource):
+                self.discard(resource)
+            else:
+                return resource
+
+    def checkin(self, resource):
+        now = time.monotonic()
+        expired = []
+        with self.__pool_lock__:
+            self.__idle__.append((resource, now))
+            while self.max_idle is not None and now - self.__idle__[0][1] > self.max_idle:
+                expired.append(self.__idle__.popleft()[0])
+        for r in expired:
+            self.discard(r)
+
+    def discard(self, resource):
+        with self.__pool_lock__:
+            self.discarded += 1
+        if self.close is not None:
+            self.close(resource)
+
+    def idle(self):
+        return len(self.__idle__)
+
+    def clear(self):
+        # closes the idle resources
+        with self.__pool_lock__:
+            idle, self.__idle__ = self.__idle__, deque()
+        for r, _ in idle:
+            self.discard(r)
+
+    def __deepcopy__(self, memo):
+        # copies of a pipeline share the pool, like the resources in it
+        return self
+
+    def __getstate__(self):
+        if self.factory is None:
+            raise PipelineNodeError(
+                "PoolDevice {} needs a factory to be used by worker processes".format(self.name))
+        return {k: getattr(self, k) for k in
+                ("name", "factory", "number", "keyword", "check", "max_idle", "close")}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+class _ProcessDevice(Device):
+    # Stand-in for a Device inside pool worker processes.
+    def __init__(self, name: str, sem):
+        self.name = name
+        self.__sem__ = sem
+
+    async def aget(self):
+        await _aacquire(self.__sem__)
+
     def release(self):
         self.__sem__.release()
 
@@ -44,11 +1458,63 @@ class Node():
             dev: Device = None,
             hold: bool = False,
             keyName=None,
+            workers: int = 1,
+            batch_size: int = None,
+            stack: bool = False,
+            cache=None,
+            coalesce_key=None,
+            flush_size: int = None,
+            flush_ms: float = None,
+            kind: str = "map",
+            timeout: float = None,
+            retries: int = 0,
+            backoff: float = 0.0,
             **refer):
+        assert type(workers) == int and workers > 0, \
+            PipelineNodeError("Node workers must be a positive integer")
+        assert batch_size is None or (type(batch_size) == int and batch_size > 0), \
+            PipelineNodeError("Node batch_size must be a positive integer")
         self._fn = clb
         self._dev = dev
         self._refer = refer
         self._hold = hold
+        self._workers = workers
+        self._batch_size = batch_size
+        self._stack = stack
+        if cache is True:
+            cache = NodeCache()
+        elif type(cache) == int:
+            cache = NodeCache(maxsize=cache)
+        assert cache is None or isinstance(cache, NodeCache), \
+            PipelineNodeError("Node cache must be True, a maxsize or a NodeCache")
+        self._cache = cache
+        # coalesce_key=True coalesces on the item itself
+        if coalesce_key is None:
+            self._flight = None
+        else:
+            self._flight = SingleFlight(None if coalesce_key is True else coalesce_key)
+        assert kind in ("map", "flatmap", "filter"), \
+            PipelineNodeError("Node kind must be map, flatmap or filter, not {}".format(kind))
+        # flatmap: fn returns or yields any number of outputs;
+        # filter: fn returns a truth value, false drops the item
+        self._kind = kind
+        assert flush_size is None or (type(flush_size) == int and flush_size > 0), \
+            PipelineNodeError("Node flush_size must be a positive integer")
+        assert flush_ms is None or flush_ms > 0, \
+            PipelineNodeError("Node flush_ms must be a positive number of milliseconds")
+        # a sink writes the items it receives in bulk, fn gets a list
+        if flush_size is None and flush_ms is None:
+            self._sink = None
+        else:
+            self._sink = MicroBatch(clb, flush_size, None if flush_ms is None else flush_ms / 1000, self)
+        # timeout in seconds for each call; retries after errors (timeouts
+        # included), backoff seconds doubled after each attempt
+        if timeout is None and not retries:
+            self._retry = None
+        else:
+            assert self._sink is None, \
+                PipelineNodeError("sink Nodes take no timeout or retries")
+            self._retry = Retry(timeout, retries, backoff)
         if hold:
             assert keyName, PipelineNodeError(
                 "Invalid keyName for Node %s" %
@@ -81,6 +1547,33 @@ class Node():
     def get_refer(self):
         return self._refer
 
+    def get_workers(self):
+        return self._workers
+
+    def get_batch_size(self):
+        return self._batch_size
+
+    def get_stack(self):
+        return self._stack
+
+    def get_cache(self):
+        return self._cache
+
+    def get_flight(self):
+        return self._flight
+
+    def get_device(self):
+        return self._dev
+
+    def get_sink(self):
+        return self._sink
+
+    def get_kind(self):
+        return self._kind
+
+    def get_retry(self):
+        return self._retry
+
     def __str__(self):
         return "Node(Function: {}, Device: {},  Hold: {})".format(
             self._fn, self._dev, self._hold)
@@ -92,10 +1585,90 @@ class Node():
         if self.has_device():
             self._dev.get()
 
+    async def aobtain_device(self):
+        if self.has_device():
+            await self._dev.aget()
+
     def return_device(self):
         if self.has_device():
             self._dev.release()
 
+def _has_state(n):
+    # tasks a clone of their pipeline cannot share
+    return isinstance(n, Pipeline) or isinstance(n.get_fn(), (Pipeline, Branch)) or \
+        n.get_sink() is not None or n.get_retry() is not None
+
+
+def _clone_task(n):
+    if not _has_state(n):
+        return n
+    if isinstance(n, Pipeline):
+        return n.clone()
+    f = n.get_fn()
+    n = copy.copy(n)
+    if isinstance(f, (Pipeline, Branch)):
+        n._fn = f.clone()
+    if n.get_sink() is not None:
+        n._sink = copy.copy(n.get_sink())
+        n._sink.node = n
+    if n.get_retry() is not None:
+        n._retry = copy.copy(n.get_retry())
+    return n
+
+
+class Branch():
+    # Node function fanning an item out to several pipelines or functions
+    # run at the same time, joined into a tuple of their outputs, or a dict
+    # for named branches. Branches run on the thread pool of the pipeline,
+    # or on a pool of their own of `workers` threads when it has none.
+    def __init__(self, *branches, workers: int = None, **named):
+        assert bool(branches) != bool(named), \
+            PipelineNodeError("Branch takes either positional or named branches")
+        self.names = tuple(named) if named else None
+        self.branches = tuple(named.values()) if named else branches
+        self.workers = workers or len(self.branches)
+        self.__pool__ = None
+        self.__pool_lock__ = threading.Lock()
+
+    def __repr__(self):
+        return "Branch({})".format(", ".join(
+            str(b) for b in (self.names or self.branches)))
+
+    def pipelines(self):
+        return [b for b in self.branches if isinstance(b, Pipeline)]
+
+    def join(self, outputs):
+        if self.names is None:
+            return tuple(outputs)
+        return dict(zip(self.names, outputs))
+
+    def pool(self):
+        with self.__pool_lock__:
+            if self.__pool__ is None:
+                self.__pool__ = ThreadPoolExecutor(max_workers=self.workers)
+            return self.__pool__
+
+    def shutdown(self, wait: bool = True):
+        with self.__pool_lock__:
+            pool, self.__pool__ = self.__pool__, None
+        if pool is not None:
+            pool.shutdown(wait=wait)
+
+    def clone(self):
+        branches = [b.clone() if isinstance(b, Pipeline) else b for b in self.branches]
+        if self.names is None:
+            return Branch(*branches, workers=self.workers)
+        return Branch(workers=self.workers, **dict(zip(self.names, branches)))
+
+    def __getstate__(self):
+        return {"names": self.names, "branches": self.branches, "workers": self.workers}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__pool__ = None
+        self.__pool_lock__ = threading.Lock()
+
+
 class LockedPipelineError(Exception):
     pass
 
@@ -116,16 +1689,50 @@ class Pipeline():
     def __init__(self, functions_list: list = None,
                  parallel: bool = False,
                  workers: int = 1,
-                 executor: concurrent.futures.Executor = ThreadPoolExecutor):
+                 executor: concurrent.futures.Executor = ThreadPoolExecutor,
+                 max_in_flight: int = None,
+                 ordered: bool = False,
+                 staged: bool = False,
+                 queue_size: int = 16,
+                 chunksize: int = 64,
+                 metrics: bool = False,
+                 errors: str = "raise"):
         self.__tasks__ = []
         self.holding = {}
+        self.__plan__ = ()
+        self.__aplan__ = ()
+        self.__batches__ = {}
+        self.__keys__ = {}
+        self.__external__ = ()
+        self.__source_slot__ = None
+        self.__windows__ = []
+        self.__pool__ = None
+        self.__owns_pool__ = False
+        self.__borrowers__ = []
+        self.__metrics__ = Metrics() if metrics else None
+        self.failures = []
+        self.__errors__ = "raise"
+        self.__error_sink__ = None
+        self.__tracer__ = None
+        self.__checkpoint__ = None
+        self.__ledger__ = None
+        self.__autoscale__ = None
+        self.__sinks__ = ()
+        self.__filters__ = frozenset()
+        self.__flats__ = frozenset()
         self.__locked__ = False
         self.__valid__ = False
         self.__parallel__ = parallel
         self.set_parallel(
             parallel=parallel,
             workers=workers,
-            executor=executor)
+            executor=executor,
+            max_in_flight=max_in_flight,
+            ordered=ordered,
+            staged=staged,
+            queue_size=queue_size,
+            chunksize=chunksize)
+        self.set_errors(errors)
         if functions_list is not None and len(functions_list) > 0:
              for i in functions_list:
                 if isinstance(i, Node):
@@ -138,25 +1745,348 @@ class Pipeline():
             self,
             parallel: bool = False,
             workers: int = 6,
-            executor: concurrent.futures.Executor = ThreadPoolExecutor):
+            executor: concurrent.futures.Executor = ThreadPoolExecutor,
+            max_in_flight: int = None,
+            ordered: bool = False,
+            staged: bool = False,
+            queue_size: int = 16,
+            chunksize: int = 64):
+        assert max_in_flight is None or max_in_flight > 0, \
+            Exception("max_in_flight must be a positive number of items")
+        assert queue_size > 0, Exception("queue_size must be a positive number of items")
+        assert chunksize > 0, Exception("chunksize must be a positive number of items")
+        self.shutdown()
+        parallel = parallel or staged
+        # workers are a fixed number again
+        self.__autoscale__ = None
+        self.__parallel__ = parallel
+        self.__ordered__ = ordered
+        self.__staged__ = staged
+        self.__queue_size__ = queue_size
+        self.__chunksize__ = chunksize
+        # with a process pool, max_in_flight counts chunks
+        self.__processes__ = parallel and not staged and \
+            isinstance(executor, type) and issubclass(executor, ProcessPoolExecutor)
         if parallel:
             self.__max_workers__ = workers
             self.__executor__ = executor
+            # staged pipelines size their window from the queues when unset
+            self.__max_in_flight__ = max_in_flight if staged else (max_in_flight or 2 * workers)
             self.process = self.__parallel_process
         else:
             self.__max_workers__ = 1
             self.__executor__ = None
+            self.__max_in_flight__ = 1
             self.process = self.__single_process
+        if self.isLocked():
+            self.__compile__()
 
     def is_parallel(self):
         return self.__parallel__
 
+    def is_staged(self):
+        return self.__staged__
+
+    def is_multiprocess(self):
+        return self.__processes__
+
+    def is_ordered(self):
+        return self.__ordered__ or not self.__parallel__
+
+    def reorder_depth(self):
+        return max((w.peak for w in self.__windows__), default=0)
+
     def copy(self):
         return copy.deepcopy(self)
 
+    def clone(self, **holding):
+        # A new pipeline over the same nodes, much cheaper than copy(): node
+        # functions, Devices, caches and, when nothing in it is bound to this
+        # pipeline, the compiled plan are shared. Held values (updated with
+        # `holding`), the executor, stats, failures, sink buffers, retry
+        # counters and nested pipelines are its own.
+        state = self.__getstate__()
+        shared = self.isLocked() and self.__shareable__()
+        if not shared:
+            state["__tasks__"] = [_clone_task(n) for n in self.__tasks__]
+        state["holding"] = dict(self.holding, **holding)
+        state["failures"] = []
+        for k in ("__metrics__", "__checkpoint__", "__autoscale__"):
+            # their copies keep the settings, not the counters
+            state[k] = copy.copy(state[k])
+
+        pipe = Pipeline.__new__(Pipeline)
+        if not shared:
+            pipe.__setstate__(state)
+            return pipe
+        pipe.__dict__.update(state)
+        pipe.__tasks__ = list(self.__tasks__)
+        pipe.__plan__ = self.__plan__
+        pipe.__aplan__ = None
+        pipe.__batches__ = self.__batches__
+        pipe.__sinks__ = ()
+        pipe.process = pipe.__parallel_process if pipe.__parallel__ else pipe.__single_process
+        return pipe
+
+    def __shareable__(self):
+        # the compiled plan closes over nothing of this pipeline
+        if self.__errors__ == "capture" or self.__metrics__ is not None or \
+                self.__tracer__ is not None:
+            return False
+        return not any(_has_state(n) for n in self.__tasks__)
+
+    def set_metrics(self, enabled: bool = True, hooks: list = (), samples: int = 1024):
+        # Per node call counts, errors, latency percentiles over the last
+        # `samples` calls and Device wait. Disabled nodes run unwrapped.
+        self.__metrics__ = Metrics(hooks, samples) if enabled else None
+        self.__recompile__()
+
+    def __recompile__(self):
+        # after a setting changed; process pool workers keep the copy of the
+        # pipeline their pool started with, the next run starts a new pool
+        if self.isLocked():
+            self.__compile__()
+        if self.__processes__ and self.__pool__ is not None:
+            self.shutdown()
+
+    def add_hook(self, hook):
+        if self.__metrics__ is None:
+            self.set_metrics(hooks=[hook])
+        else:
+            self.__metrics__.add_hook(hook)
+            self.__recompile__()
+
+    def reset_stats(self):
+        if self.__metrics__ is not None:
+            self.__metrics__.reset()
+
+    def stats(self):
+        stats = {}
+        for k, n in enumerate(self.__tasks__):
+            name = self.__node_name__(k, n)
+            stats[name] = {} if self.__metrics__ is None else \
+                self.__metrics__.node(name).snapshot()
+            if isinstance(n, Node) and n.get_cache() is not None:
+                stats[name]["cache"] = n.get_cache().stats()
+            if isinstance(n, Node) and n.get_flight() is not None:
+                stats[name]["coalesced"] = n.get_flight().shared
+            if isinstance(n, Node) and n.get_retry() is not None:
+                stats[name].update(n.get_retry().stats())
+        return stats
+
+    def __retries__(self):
+        return [(k, n.get_retry()) for k, n in enumerate(self.__tasks__)
+                if isinstance(n, Node) and n.get_retry() is not None]
+
+    def __node_name__(self, k, n):
+        f = n.get_fn() if isinstance(n, Node) else n
+        return "{}:{}".format(k, getattr(f, "__name__", type(f).__name__))
+
+    def set_autoscale(self, enabled: bool = True, min_workers: int = 1, max_workers: int = None,
+                      interval: float = 0.5, **options):
+        # Lets process() change how many workers are busy, between
+        # min_workers and max_workers (the pipeline workers by default),
+        # from the throughput, node latency and Device wait it measures;
+        # metrics are enabled for it. The pool keeps max_workers and the
+        # in-flight window follows the chosen number. Autoscaler takes the
+        # other options.
+        if not enabled:
+            self.__autoscale__ = None
+            return
+        assert self.__parallel__ and not self.__staged__, \
+            PipelineNodeError("autoscale needs a parallel pipeline, not a staged one")
+        max_workers = max_workers or self.__max_workers__
+        self.__autoscale__ = Autoscaler(min_workers, max_workers, interval, **options)
+        if max_workers != self.__max_workers__:
+            self.shutdown()
+            self.__max_workers__ = max_workers
+        if self.__metrics__ is None:
+            self.set_metrics()
+
+    def get_autoscaler(self):
+        return self.__autoscale__
+
+    def __scaled__(self, source):
+        if self.__autoscale__ is None:
+            return source
+        self.__autoscale__.begin(self.__windows__, self.__metrics__)
+        return self.__autoscale__.track(source)
+
+    def set_checkpoint(self, path: str = None, every: int = 1000):
+        # process() and iprocess() save their progress to path every `every`
+        # finished inputs and when they end; None stops checkpointing
+        self.__checkpoint__ = None if path is None else Checkpoint(path, every)
+
+    def get_checkpoint(self):
+        return self.__checkpoint__
+
+    def set_errors(self, mode: str = "raise", sink: Callable = None):
+        # "raise" stops at the first error: pending items are cancelled and
+        # no more are taken from the source. "capture" hands a Failure for
+        # each failed item to sink, or to self.failures, and goes on.
+        assert mode in ("raise", "capture"), \
+            PipelineNodeError("errors must be raise or capture, not {}".format(mode))
+        self.__errors__ = mode
+        self.__error_sink__ = sink
+        self.__recompile__()
+
+    def __capture__(self, failure):
+        if self.__error_sink__ is None:
+            self.failures.append(failure)
+        else:
+            self.__error_sink__(failure)
+
+    def set_tracer(self, tracer=None):
+        # Records node and Device events of this pipeline and the pipelines
+        # nested in it into tracer; None stops tracing.
+        self.__tracer__ = tracer
+        for sub in self.__nested__():
+            sub.set_tracer(tracer)
+        self.__recompile__()
+
+    def get_tracer(self):
+        return self.__tracer__
+
+    def __instruments__(self, k, n):
+        # _with_metrics arguments for node k, None when neither metrics
+        # nor tracing is enabled
+        if self.__metrics__ is None and self.__tracer__ is None:
+            return None
+        name = self.__node_name__(k, n)
+        return {"stats": None if self.__metrics__ is None else self.__metrics__.node(name),
+                "hooks": () if self.__metrics__ is None else self.__metrics__.hooks,
+                "tracer": self.__tracer__,
+                "name": name}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the compiled plan closes over this instance's state and the bound
+        # process method cannot be pickled by name; both are rebuilt on load.
+        # Executors are never shared with a copy.
+        del state["__plan__"]
+        del state["__aplan__"]
+        del state["__batches__"]
+        del state["__sinks__"]
+        del state["process"]
+        state["__windows__"] = []
+        state["__ledger__"] = None
+        state["__pool__"] = None
+        state["__owns_pool__"] = False
+        state["__borrowers__"] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__plan__ = ()
+        self.__aplan__ = ()
+        self.__batches__ = {}
+        self.__sinks__ = ()
+        self.__filters__ = frozenset()
+        self.__flats__ = frozenset()
+        self.process = self.__parallel_process if self.__parallel__ else self.__single_process
+        if self.isLocked():
+            self.__compile__()
+
     def __call__(self, args):
         return self.push(args)
 
+    def __enter__(self):
+        if not self.isLocked():
+            self.lock()
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def start(self):
+        # staged pipelines run on per-stage threads started by each run
+        if not self.__parallel__ or self.__staged__ or self.__pool__ is not None:
+            return self
+
+        if self.__processes__:
+            payload = io.BytesIO()
+            pickler = _DevicePickler(payload)
+            pickler.dump(self)
+            devices = [d.__shared__() for d in pickler.devices]
+            self.__pool__ = self.__executor__(
+                max_workers=self.__max_workers__,
+                initializer=_init_worker,
+                initargs=(payload.getvalue(), devices))
+            self.__owns_pool__ = True
+            return self
+
+        subs = self.__parallel_subpipelines__()
+        workers = self.__max_workers__ + sum(s.__max_workers__ for s in subs)
+        self.__pool__ = self.__executor__(max_workers=workers)
+        self.__owns_pool__ = True
+        for sub in subs:
+            sub.__borrow__(self.__pool__)
+        self.__borrowers__ = subs
+        return self
+
+    def shutdown(self, wait: bool = True):
+        self.flush()
+        for n in getattr(self, "__tasks__", ()):
+            if isinstance(n, Node) and isinstance(n.get_fn(), Branch):
+                n.get_fn().shutdown(wait)
+        for sub in getattr(self, "__borrowers__", ()):
+            if sub.__pool__ is self.__pool__:
+                sub.__pool__ = None
+        self.__borrowers__ = []
+
+        pool, self.__pool__ = getattr(self, "__pool__", None), None
+        if pool is not None and self.__owns_pool__:
+            pool.shutdown(wait=wait)
+        self.__owns_pool__ = False
+
+    def flush(self):
+        # writes what the sink nodes of this and nested pipelines buffer
+        for sink in getattr(self, "__sinks__", ()):
+            sink.flush()
+        for sub in self.__nested__():
+            sub.flush()
+
+    def __all_sinks__(self):
+        # sink buffers of this and nested pipelines, in a stable order
+        sinks = list(getattr(self, "__sinks__", ()))
+        for sub in self.__nested__():
+            sinks.extend(sub.__all_sinks__())
+        return sinks
+
+    def __has_sinks__(self):
+        return bool(self.__sinks__) or any(sub.__has_sinks__() for sub in self.__nested__())
+
+    def __nested__(self):
+        # the pipelines run by the nodes of this one
+        for n in getattr(self, "__tasks__", ()):
+            f = n if isinstance(n, Pipeline) else n.get_fn()
+            if isinstance(f, Pipeline):
+                yield f
+            elif isinstance(f, Branch):
+                yield from f.pipelines()
+
+    def __flush_after__(self, stream):
+        yield from stream
+        self.flush()
+
+    async def __aflush_after__(self, stream):
+        async for i in stream:
+            yield i
+        await asyncio.get_event_loop().run_in_executor(None, self.flush)
+
+    def __borrow__(self, pool):
+        self.shutdown()
+        self.__pool__ = pool
+
+    def __parallel_subpipelines__(self):
+        subs = []
+        for n in self.__tasks__:
+            f = n if isinstance(n, Pipeline) else n.get_fn()
+            if isinstance(f, Pipeline) and f.is_parallel():
+                subs.append(f)
+                subs.extend(f.__parallel_subpipelines__())
+        return subs
+
     def __repr__(self):
         return "Pipeline:\"parallel: {}, workers: {}, executor: {}, steps: [{}]\"".format(
             self.__parallel__, self.__max_workers__, self.__executor__, [
@@ -198,16 +2128,371 @@ class Pipeline():
         return self.__locked__
 
     def lock(self):
+        for n in self.__tasks__:
+            if isinstance(n, Node) and isinstance(n.get_fn(), Branch):
+                for sub in n.get_fn().pipelines():
+                    if not sub.isLocked():
+                        sub.lock()
         self.__validate__()
+        self.__compile__()
         self.__locked__ = True
+        self.start()
+
+    def __compile__(self):
+        nodes = [n if isinstance(n, Node) else Node(n) for n in self.__tasks__]
+        self.__assign_slots__(nodes)
+        # pipelines capturing their errors carry the source item after the
+        # held values, for the failures to record
+        self.__source_slot__ = len(self.__keys__) if self.__errors__ == "capture" else None
+        instruments = [self.__instruments__(k, n) for k, n in enumerate(nodes)]
+        self.__sinks__ = tuple(n.get_sink() for n in nodes if n.get_sink() is not None)
+        self.__filters__ = frozenset(k for k, n in enumerate(nodes) if n.get_kind() == "filter")
+        if self.__errors__ == "capture":
+            # a failed item is dropped by the node it failed on
+            self.__filters__ = frozenset(range(len(nodes)))
+        self.__flats__ = frozenset(k for k, n in enumerate(nodes) if n.get_kind() == "flatmap")
+        self.__batches__ = {
+            k: (self.__compile_batch__(n, instruments[k], self.__node_name__(k, n)),
+                n.get_batch_size())
+            for k, n in enumerate(nodes) if n.get_batch_size()}
+        self.__plan__ = tuple(
+            _unbatch(self.__batches__[k][0]) if k in self.__batches__
+            else self.__compile_step__(n, instruments[k], self.__node_name__(k, n))
+            for k, n in enumerate(nodes))
+        self.__aplan__ = None
+
+    def __async_plan__(self):
+        # compiled on first use: pipelines that never run async skip it
+        if self.__aplan__ is None:
+            nodes = [n if isinstance(n, Node) else Node(n) for n in self.__tasks__]
+            self.__aplan__ = tuple(
+                _offload(_unbatch(self.__batches__[k][0]), self) if k in self.__batches__
+                else self.__compile_async_step__(
+                    n, self.__instruments__(k, n), self.__node_name__(k, n))
+                for k, n in enumerate(nodes))
+        return self.__aplan__
+
+    def __assign_slots__(self, nodes):
+        # Every held or referred key gets a slot in the per-item context.
+        # Keys no node holds before they are referred are taken from
+        # self.holding when an item starts. A key held later gives the value
+        # of the previous item, which only a single thread can tell.
+        keys = {}
+        external = []
+        for k, n in enumerate(nodes):
+            for key in _refer_keys(n):
+                if key in keys:
+                    continue
+                if self.__parallel__ and \
+                        any(m.get_hold() and m.get_key() == key for m in nodes[k:]):
+                    raise PipelineNodeError(
+                        "Node {} refers to {} before any node holds it, "
+                        "which a parallel pipeline cannot do".format(n.get_fn(), key))
+                keys[key] = len(keys)
+                external.append((keys[key], key))
+            if n.get_hold() and n.get_key() not in keys:
+                keys[n.get_key()] = len(keys)
+        self.__keys__ = keys
+        self.__external__ = tuple(external)
+
+    def __new_ctx__(self, i=None):
+        if not self.__keys__ and self.__source_slot__ is None:
+            return None
+        ctx = [None] * len(self.__keys__)
+        for slot, key in self.__external__:
+            ctx[slot] = self.holding[key]
+        if self.__source_slot__ is not None:
+            ctx.append(i)
+        return ctx
+
+    def __contexts__(self, source):
+        if self.__ledger__ is not None:
+            # checkpointed runs carry the source offset at the end of contexts
+            ledger = self.__ledger__
+            return ((i, (self.__new_ctx__(i) or []) + [ledger.pull()]) for i in source)
+        if not self.__keys__ and self.__source_slot__ is None:
+            return ((i, None) for i in source)
+        return ((i, self.__new_ctx__(i)) for i in source)
+
+    def __kept__(self, pairs):
+        if self.__ledger__ is None:
+            return _kept(pairs)
+        return self.__counted_kept(pairs, self.__ledger__)
+
+    def __counted_kept(self, pairs, ledger):
+        for p in pairs:
+            if p[0] is _DROP:
+                ledger.done(p[1][-1])
+            else:
+                yield p
+
+    def __flat_runner__(self, k):
+        if self.__ledger__ is None:
+            return functools.partial(_run_flat, self.__plan__[k])
+        return functools.partial(_run_counted_flat, self.__ledger__, self.__plan__[k])
+
+    def __flat_run__(self):
+        # later flatmap slices go to the pool as well; a borrowed pool may
+        # be busy with the very item waiting on them
+        if not self.__owns_pool__:
+            return None
+        pool = self.__pool__
+        return lambda more: pool.submit(more).result()
+
+    def __committed__(self, pairs):
+        if self.__ledger__ is None:
+            return pairs
+        return self.__counted_committed(pairs, self.__ledger__)
+
+    def __counted_committed(self, pairs, ledger):
+        # an input is done once its outputs are handed over
+        sinks = self.__all_sinks__()
+        for p in pairs:
+            yield p
+            ledger.done(p[1][-1])
+            if ledger.due():
+                ledger.save(sinks)
+
+    async def __acontexts__(self, source):
+        async for i in source:
+            yield i, self.__new_ctx__(i)
+
+    def __compile_batch__(self, n, instruments=None, name=None):
+        f = n.get_fn()
+        if isinstance(n.get_device(), PoolDevice):
+            f = _with_resource(f, n.get_device())
+        call = _batch_adapter(f, n.get_stack(), self.__refs__(n))
+        device = n if self.__holds_device__(n) else None
+        retry = n.get_retry()
+
+        if retry is not None and retry.timeout is not None:
+            call = _with_timeout(call, retry)
+
+        if instruments is not None:
+            call = _with_metrics(call, node=device, **instruments)
+        elif device is not None:
+            call = _with_device(call, n)
+
+        if retry is not None and retry.retries:
+            call = _with_retry(call, retry)
+
+        if n.get_cache() is not None:
+            call = _with_batch_cache(call, n.get_cache(), self.__refs__(n))
+
+        if n.get_hold():
+            call = _with_batch_hold(call, self.__keys__[n.get_key()])
+
+        if self.__errors__ == "capture":
+            call = _with_batch_capture(call, name, self.__capture__, self.__source_slot__)
+
+        return call
+
+    def __segments__(self, start, asynchronous=False):
+        # Splits the plan from `start` at batch nodes: (fn, None) runs a
+        # range of steps on one item, (fn, size) runs a batch node on a list.
+        plan = self.__async_plan__() if asynchronous else self.__plan__
+        segments = []
+        begin = start
+        for k in range(start, len(plan)):
+            if k in self.__batches__ or k in self.__flats__:
+                if begin < k:
+                    segments.append((self.__runner__(plan, begin, k, asynchronous), None))
+                if k in self.__batches__:
+                    call, size = self.__batches__[k]
+                    call = functools.partial(_run_batch, call)
+                else:
+                    call, size = self.__flat_runner__(k), _FLAT
+                segments.append((_offload(call, self) if asynchronous else call, size))
+                begin = k + 1
+        if begin < len(plan) or not segments:
+            segments.append((self.__runner__(plan, begin, len(plan), asynchronous), None))
+        return segments
+
+    def __runner__(self, plan, begin, end, asynchronous=False):
+        # only the steps of pipelines with filters check for dropped items
+        if any(begin <= k < end for k in self.__filters__):
+            runner = _arun_filtered if asynchronous else _run_filtered
+        else:
+            runner = _arun_steps if asynchronous else _run_steps
+        return functools.partial(runner, plan[begin:end])
+
+    def __chain__(self, source, start):
+        pairs = self.__committed__(self.__pairs__(self.__contexts__(source), start))
+        if self.__keys__ and not self.__parallel__:
+            pairs = self.__published__(pairs)
+        return _values(pairs)
+
+    def __published__(self, pairs):
+        # a single thread hands the held values of an item to the next one,
+        # and those of the last item to retrieve()
+        for p in pairs:
+            self.__publish__(p[1])
+            yield p
+
+    def __pairs__(self, stream, start):
+        for fn, size in self.__segments__(start):
+            if size is None:
+                stream = map(fn, stream)
+            elif size is _FLAT:
+                stream = _expanded(map(fn, stream))
+            else:
+                stream = itertools.chain.from_iterable(map(fn, _chunks(stream, size)))
+            if self.__filters__:
+                stream = self.__kept__(stream)
+        return stream
+
+    def __holds_device__(self, n):
+        # a single thread needs no semaphore, a rate limit applies anyway
+        return n.has_device() and (self.__parallel__ or isinstance(n.get_device(), RateDevice))
+
+    def __refs__(self, n):
+        return tuple(self.__keys__[k] for k in _refer_keys(n))
+
+    def __node_call__(self, n):
+        f = n.get_fn()
+        argc = _arity(f)
+        if isinstance(n.get_device(), PoolDevice):
+            argc -= _takes_positional(f, n.get_device().keyword)
+            f = _with_resource(f, n.get_device())
+        return _adapter(f, argc, self.__refs__(n))
+
+    def __compile_step__(self, n, instruments=None, name=None):
+        if isinstance(n, Pipeline):
+            n = Node(n)
+        f = n.get_fn()
+
+        if n.get_sink() is not None:
+            call = _sink_adapter(n.get_sink())
+        elif isinstance(f, Branch):
+            call = _branch_adapter(f, self)
+        elif isinstance(f, Pipeline):
+            call = _pipeline_adapter(f)
+        elif _is_async(f):
+            call = _run_coroutine(self.__node_call__(n))
+        else:
+            call = self.__node_call__(n)
+        if n.get_kind() == "flatmap":
+            call = _flat_adapter(call)
+        # a sink holds its Device while it writes a batch
+        device = n if self.__holds_device__(n) and n.get_sink() is None else None
+        retry = n.get_retry()
+
+        if retry is not None and retry.timeout is not None:
+            call = _with_timeout(call, retry)
+
+        if instruments is not None:
+            call = _with_metrics(call, node=device, **instruments)
+        elif device is not None:
+            call = _with_device(call, n)
+
+        if retry is not None and retry.retries:
+            flat = n.get_kind() == "flatmap"
+            call = (_with_flat_retry if flat else _with_retry)(call, retry)
+
+        if n.get_flight() is not None:
+            call = _with_coalesce(call, n.get_flight())
+
+        if n.get_cache() is not None:
+            call = _with_cache(call, n.get_cache(), self.__refs__(n))
+
+        if n.get_kind() == "filter":
+            call = _filter_adapter(call)
+
+        if n.get_hold():
+            call = _with_hold(call, self.__keys__[n.get_key()])
+
+        if self.__errors__ == "capture":
+            capture = _with_flat_capture if n.get_kind() == "flatmap" else _with_capture
+            call = capture(call, name, self.__capture__, self.__source_slot__)
+
+        return call
+
+    def __compile_async_step__(self, n, instruments=None, name=None):
+        if isinstance(n, Pipeline):
+            n = Node(n)
+        f = n.get_fn()
+
+        retry = n.get_retry()
+        timeout = retry is not None and retry.timeout is not None
+
+        if n.get_sink() is not None:
+            call = _offload(_sink_adapter(n.get_sink()), self)
+        elif isinstance(f, Branch):
+            call = _async_branch_adapter(f, self)
+        elif isinstance(f, Pipeline):
+            call = _async_pipeline_adapter(f)
+        elif _is_async(f):
+            call = self.__node_call__(n)
+        else:
+            # a hung function is left on a thread of its own rather than
+            # on the pool the steps are offloaded to
+            call = self.__node_call__(n)
+            call = _offload(_with_timeout(call, retry) if timeout else call, self)
+            timeout = False
+        device = n if n.has_device() and n.get_sink() is None else None
+
+        if timeout:
+            call = _with_async_timeout(call, retry)
+
+        if instruments is not None:
+            call = _with_async_metrics(call, node=device, **instruments)
+        elif device is not None:
+            call = _with_async_device(call, n)
+
+        if retry is not None and retry.retries:
+            call = _with_async_retry(call, retry)
+
+        if n.get_flight() is not None:
+            call = _with_async_coalesce(call, n.get_flight())
+
+        if n.get_cache() is not None:
+            call = _with_async_cache(call, n.get_cache(), self.__refs__(n))
+
+        if n.get_kind() == "filter":
+            call = _async_filter_adapter(call)
+
+        if n.get_hold():
+            call = _with_async_hold(call, self.__keys__[n.get_key()])
+
+        if self.__errors__ == "capture":
+            call = _with_async_capture(call, name, self.__capture__, self.__source_slot__)
+
+        return call
 
     def __validate__(self):
-        if self.__parallel__:
-            for n in self.__tasks__:
-                if len(n.get_refer().keys()) > 0:
-                    raise PipelineUnsupportedReferInParallelMode(
-                        "Node {} cannot use REFER because this Pipeline is in parallel mode.".format(
-                            n.get_fn()))
+        for n in self.__tasks__:
+            if isinstance(n, Node) and n.get_kind() != "map":
+                f = n.get_fn()
+                if isinstance(f, (Pipeline, Branch)) or n.get_batch_size() or n.get_sink() is not None:
+                    raise PipelineNodeError(
+                        "{} node {} must be a plain function".format(n.get_kind(), f))
+                if n.get_kind() == "flatmap" and (
+                        _is_async(f) or n.get_hold() or n.get_cache() is not None or
+                        n.get_flight() is not None):
+                    raise PipelineNodeError(
+                        "flatmap node {} cannot be async, hold, cache or coalesce".format(f))
+            if isinstance(n, Node) and n.get_sink() is not None:
+                f = n.get_fn()
+                if isinstance(f, (Pipeline, Branch)) or _is_async(f):
+                    raise PipelineNodeError(
+                        "Sink node {} must be a plain function".format(f))
+                if n.get_batch_size() or n.get_cache() is not None or \
+                        n.get_flight() is not None or n.get_refer():
+                    raise PipelineNodeError(
+                        "Sink node {} cannot batch, cache, coalesce or refer".format(f))
+                if isinstance(n.get_device(), AsyncDevice):
+                    # bulk calls also run from the flush timer and at the end
+                    # of a run, out of any event loop
+                    raise PipelineNodeError(
+                        "Sink node {} cannot use AsyncDevice {}".format(f, n.get_device().name))
+            if isinstance(n, Node) and n.get_batch_size():
+                f = n.get_fn()
+                if isinstance(f, (Pipeline, Branch)) or _is_async(f):
+                    raise PipelineNodeError(
+                        "Batch node {} must be a plain function".format(f))
+                if n.get_flight() is not None:
+                    raise PipelineNodeError(
+                        "Batch node {} cannot use coalesce_key".format(f))
 
     def unlock(self):
         if self.isLocked():
@@ -217,6 +2502,13 @@ class Pipeline():
                 "Unlocking pipline after being lock. This should not happen")
 
         self.__locked__ = False
+        self.__plan__ = ()
+        self.__aplan__ = ()
+        self.__batches__ = {}
+        self.__keys__ = {}
+        self.__sinks__ = ()
+        self.__filters__ = frozenset()
+        self.__flats__ = frozenset()
 
     def hold(self, k, v):
         self.holding[k] = v
@@ -229,136 +2521,280 @@ class Pipeline():
             raise UnlockedPipelineError(
                 "Pipeline must be locked before execution.")
 
-        for c in range(start, len(self.__tasks__)):
-            n = self.__tasks__[c]
-            f = n.get_fn()
+        ctx = self.__new_ctx__(i)
+        if self.__filters__ or self.__flats__:
+            return self.__push_stream__(i, ctx, start, publish=True)
+        for step in (self.__plan__ if start == 0 else self.__plan__[start:]):
+            i = step(i, ctx)
 
-            h = n.get_hold()
-            k = n.get_key()
-            r = n.get_refer()
-            try:
-                if self.is_parallel() and isinstance(n, Node) and n.has_device():
-                    n.obtain_device()
-
-                if isinstance(f, Pipeline):
-                    if f.__parallel__:
-                        f = f.process
-                        if not isinstance(i, Iterable):
-                            i = [i]
-                    else:
-                        f = f.push
-                elif isinstance(f, object) and not hasattr(f, "__code__"): 
-                    f = f.__call__
-
-                if isinstance(i, type(None)):
-                    i = f()
-                elif isinstance(i, tuple):
-                    if f.__code__.co_argcount == 0:
-                        if r is None:
-                            i = f()
-                        else:
-                            i = f(*r.values())
-                    elif f.__code__.co_argcount == 1:
-                        if r is None:
-                            i = f(i)
-                        else:
-                            i = f(i, *r.values())
-                    else:
-                        if r is None:
-                            i = f(*i)
-                        else:
-                            i = f(*i, *r.values())
-                else:
-                    if f.__code__.co_argcount > 0:
-                        if r is None or len(r) == 0:
-                            i = f(i)
-                        else:
-                            v = [self.holding[ik] for ik in list(*r.values())]
-                            i = f(i, *v)
-                    else:
-                        if r is None or len(r) == 0:
-                            i = f()
-                        else:
-                            v = [self.holding[ik] for ik in list(*r.values())]
-                            i = f(*v)
-
-            except Exception as e:
-                raise e
+        if ctx is not None:
+            self.__publish__(ctx)
+        return i
 
-            finally:
-                if self.is_parallel() and isinstance(n, Node) and n.has_device():
-                    n.return_device()
+    def __run__(self, i=None, start=0):
+        # push() for nested pipelines, keeping held values out of self.holding
+        if not self.isLocked():
+            raise UnlockedPipelineError(
+                "Pipeline must be locked before execution.")
 
-            if h:
-                self.hold(k, i)
+        ctx = self.__new_ctx__(i)
+        if self.__filters__ or self.__flats__:
+            return self.__push_stream__(i, ctx, start)
+        for step in (self.__plan__ if start == 0 else self.__plan__[start:]):
+            i = step(i, ctx)
+        return i
+
+    def __push_stream__(self, i, ctx, start, publish=False):
+        # With flatmap nodes push() returns the list of outputs, with
+        # filters only the output or None when the item was dropped.
+        pairs = list(self.__pairs__([(i, ctx)], start))
+        if publish and ctx is not None and pairs:
+            self.__publish__(pairs[-1][1])
+        if self.__flats__:
+            return [o for o, _ in pairs]
+        return pairs[0][0] if pairs else None
+
+    async def __apush_stream__(self, i, ctx, start, publish=False):
+        pairs = [p async for p in self.__apairs__(_aiterate([(i, ctx)]), start)]
+        if publish and ctx is not None and pairs:
+            self.__publish__(pairs[-1][1])
+        if self.__flats__:
+            return [o for o, _ in pairs]
+        return pairs[0][0] if pairs else None
+
+    def __publish__(self, ctx):
+        # a single push() leaves its held values available to retrieve()
+        for key, slot in self.__keys__.items():
+            self.holding[key] = ctx[slot]
+
+    async def apush(self, i=None, start=0):
+        if not self.isLocked():
+            raise UnlockedPipelineError(
+                "Pipeline must be locked before execution.")
+
+        ctx = self.__new_ctx__(i)
+        if self.__filters__ or self.__flats__:
+            return await self.__apush_stream__(i, ctx, start, publish=True)
+        plan = self.__async_plan__()
+        for step in (plan if start == 0 else plan[start:]):
+            i = await step(i, ctx)
+
+        if ctx is not None:
+            self.__publish__(ctx)
+        return i
+
+    async def __arun__(self, i=None, start=0):
+        if not self.isLocked():
+            raise UnlockedPipelineError(
+                "Pipeline must be locked before execution.")
 
+        ctx = self.__new_ctx__(i)
+        if self.__filters__ or self.__flats__:
+            return await self.__apush_stream__(i, ctx, start)
+        plan = self.__async_plan__()
+        for step in (plan if start == 0 else plan[start:]):
+            i = await step(i, ctx)
         return i
 
-    def __single_process(self, input_iterable=None):
-        results = []
-        if input_iterable is None:
-            g: Callable = self.__tasks__[0].get_fn()
-            assert isinstance(g, FunctionType) or \
-                   isinstance(g, Generator), \
-                   ProcessNoGeneratorError(
-                       "{} require a generator at first step for {}.process() but received {}".format(
-                        self, self, type(g))
-                    )
-
-            if isinstance(g, FunctionType) and g is not None:
-                for i in g():
-                    i = self.push(i, start=1)
-                    results.append(i)
-            elif isinstance(g, Generator) and g is not None:
-                for i in g:
-                    i = self.push(i, start=1)
-                    results.append(i)
+    def __asource__(self, input_iterable=None):
+        if input_iterable is not None:
+            return _aiterate(input_iterable), 0
+
+        g = self.__tasks__[0].get_fn()
+        if inspect.isasyncgenfunction(g):
+            return g(), 1
+        if inspect.isasyncgen(g):
+            return g, 1
+        source, start = self.__source__()
+        return _aiterate(source), start
+
+    def aiter_process(self, input_iterable=None, concurrency: int = None):
+        if not self.isLocked():
+            raise UnlockedPipelineError(
+                "Pipeline must be locked before execution.")
+
+        source, start = self.__asource__(input_iterable)
+        stream = _avalues(self.__apairs__(self.__acontexts__(source), start, concurrency))
+        return self.__aflush_after__(stream) if self.__has_sinks__() else stream
+
+    def __apairs__(self, stream, start, concurrency=None):
+        self.__windows__ = []
+        for fn, size in self.__segments__(start, asynchronous=True):
+            window = _AsyncWindowMap(
+                fn,
+                stream if size is None or size is _FLAT else _achunks(stream, size),
+                concurrency or self.__max_in_flight__,
+                self.is_ordered())
+            self.__windows__.append(window)
+            if size is None:
+                stream = window.__aiter__()
+            elif size is _FLAT:
+                stream = _aexpanded(window, self)
             else:
-                raise ProcessNoGeneratorError(
-                    "{} is no function for generator nor a generator itself".format(g))
+                stream = _aflatten(window)
+            if self.__filters__:
+                stream = _akept(stream)
+        return stream
+
+    async def aprocess(self, input_iterable=None, concurrency: int = None):
+        return [i async for i in self.aiter_process(input_iterable, concurrency)]
+
+    def __source__(self, input_iterable=None):
+        if input_iterable is not None:
+            return input_iterable, 0
+
+        g: Callable = self.__tasks__[0].get_fn()
+        assert isinstance(g, FunctionType) or \
+               isinstance(g, Generator), \
+               ProcessNoGeneratorError(
+                   "{} require a generator at first step for {}.process() but received {}".format(
+                    self, self, type(g))
+                )
+
+        if isinstance(g, FunctionType) and g is not None:
+            return g(), 1
+        elif isinstance(g, Generator) and g is not None:
+            return g, 1
         else:
-            for i in input_iterable:
-                i = self.push(i)
-                results.append(i)
-
-        return results
-
-    def __parallel_process(self, input_iterable=None):
-        results = []
-        futures = []
-        with self.__executor__(max_workers=self.__max_workers__) as executor:
-            if input_iterable is None:
-                g: Callable = self.__tasks__[0].get_fn()
-                assert isinstance(
-                    g, FunctionType) or isinstance(
-                        g, Generator), ProcessNoGeneratorError(
-                            "{} require a generator at first" +
-                            " step for process() but received {}".format(
-                                self, type(g)))
-
-                if isinstance(g, FunctionType):
-                    for i in g():
-                        futures.append(
-                            executor.submit(
-                                functools.partial(
-                                    self.push, i, 1)))
-                elif isinstance(g, Generator):
-                    for i in g:
-                        futures.append(
-                            executor.submit(
-                                functools.partial(
-                                    self.push, i, 1)))
-                else:
-                    raise ProcessNoGeneratorError(
-                        "{} is no function for generator nor a generator itself".format(g))
+            raise ProcessNoGeneratorError(
+                "{} is no function for generator nor a generator itself".format(g))
+
+    def iprocess(self, input_iterable=None, resume_from=None):
+        # resume_from: a checkpoint file, or the number of source items to skip
+        if not self.isLocked():
+            raise UnlockedPipelineError(
+                "Pipeline must be locked before execution.")
+
+        source, start = self.__source__(input_iterable)
+        if resume_from is not None or self.__checkpoint__ is not None:
+            return self.__checkpointed(source, start, resume_from)
+        return self.__iprocess(source, start)
+
+    def __iprocess(self, source, start):
+        if self.__staged__:
+            stream = self.__staged_iprocess(source, start)
+        elif self.__processes__:
+            return self.__multiprocess_iprocess(source, start)
+        elif self.__parallel__:
+            stream = self.__parallel_iprocess(source, start)
+        else:
+            stream = self.__chain__(source, start)
+        return self.__flush_after__(stream) if self.__has_sinks__() else stream
+
+    def __checkpointed(self, source, start, resume_from):
+        offset, batches = (0, []) if resume_from is None else Checkpoint.read(resume_from)
+        # what the sinks buffered when the checkpoint was saved is written first
+        if batches:
+            for sink, items in zip(self.__all_sinks__(), batches):
+                sink.restore(items)
+            self.flush()
+        if offset:
+            source = itertools.islice(source, offset, None)
+        ledger = self.__checkpoint__
+        if ledger is None:
+            yield from self.__iprocess(source, start)
+            return
+
+        ledger.begin(offset)
+        self.__ledger__ = ledger
+        try:
+            yield from self.__iprocess(source, start)
+        finally:
+            self.__ledger__ = None
+            # on errors too: the watermark stays behind unfinished inputs
+            ledger.save(self.__all_sinks__())
+
+    def __parallel_iprocess(self, source, start):
+        if self.__pool__ is None:
+            self.start()
+        self.__windows__ = []
+        stream = self.__contexts__(self.__scaled__(source))
+        for fn, size in self.__segments__(start):
+            window = _WindowMap(
+                self.__pool__,
+                fn,
+                stream if size is None or size is _FLAT else _chunks(stream, size),
+                self.__max_in_flight__,
+                self.__ordered__,
+                steal=not self.__owns_pool__)
+            self.__windows__.append(window)
+            if size is None:
+                stream = window
+            elif size is _FLAT:
+                stream = _expanded(window, self.__flat_run__())
             else:
-                for i in input_iterable:
-                    futures.append(
-                        executor.submit(
-                            functools.partial(self.push, i)
-                        ))
+                stream = itertools.chain.from_iterable(window)
+            if self.__filters__:
+                stream = self.__kept__(stream)
+        yield from _values(self.__committed__(stream))
+
+    def __multiprocess_iprocess(self, source, start):
+        if self.__pool__ is None:
+            self.start()
+        self.__windows__ = []
+        window = _WindowMap(
+            self.__pool__,
+            functools.partial(_run_chunk, start=start),
+            self.__offset_chunks__(self.__scaled__(source)),
+            self.__max_in_flight__,
+            self.__ordered__)
+        self.__windows__.append(window)
+        retries = dict(self.__retries__())
+        ledger = self.__ledger__
+        for offsets, chunk, drained, events, failures, counted in window:
+            if drained is not None:
+                self.__metrics__.merge(drained)
+            if events is not None:
+                self.__tracer__.merge(events)
+            for failure in failures:
+                self.__capture__(failure)
+            for k, counters in counted.items():
+                retries[k].merge(counters)
+            yield from chunk
+            if ledger is not None:
+                # workers write their sinks before a chunk returns
+                for k in offsets:
+                    ledger.done(k)
+                if ledger.due():
+                    ledger.save()
+
+    def __offset_chunks__(self, source):
+        # (offsets, items); workers know nothing of checkpoints
+        ledger = self.__ledger__
+        for chunk in _chunks(source, self.__chunksize__):
+            yield (None if ledger is None else [ledger.pull() for _ in chunk]), chunk
+
+    def __staged_iprocess(self, source, start):
+        # a flatmap node ends a line of stages; its outputs feed the next one
+        batch = _run_filtered_batch if self.__filters__ else _run_batch
+        stream = self.__contexts__(source)
+        steps, workers = [], []
+        self.__windows__ = []
+        for k in range(start, len(self.__plan__)):
+            if k in self.__batches__:
+                steps.append((functools.partial(batch, self.__batches__[k][0]),
+                              self.__batches__[k][1]))
+            elif k in self.__flats__:
+                steps.append((self.__flat_runner__(k), None))
+            else:
+                steps.append((self.__runner__(self.__plan__, k, k + 1), None))
+            n = self.__tasks__[k]
+            workers.append(n.get_workers() if isinstance(n, Node) else 1)
+
+            if k in self.__flats__ or k == len(self.__plan__) - 1:
+                window = self.__max_in_flight__ or \
+                    (len(steps) + 1) * self.__queue_size__ + sum(workers)
+                line = _StageLine(
+                    steps, workers, stream, self.__queue_size__, window, self.__ordered__)
+                self.__windows__.append(line)
+                stream = _expanded(line) if k in self.__flats__ else line
+                if self.__filters__:
+                    stream = self.__kept__(stream)
+                steps, workers = [], []
+        yield from _values(self.__committed__(stream))
 
-            for future in concurrent.futures.as_completed(futures):
-                results.append(future.result())
+    def __single_process(self, input_iterable=None, resume_from=None):
+        return list(self.iprocess(input_iterable, resume_from))
 
-        return results
+    def __parallel_process(self, input_iterable=None, resume_from=None):
+        return list(self.iprocess(input_iterable, resume_from))
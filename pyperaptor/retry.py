@@ -0,0 +1,89 @@
+import concurrent.futures
+import threading
+import asyncio
+
+
+class NodeTimeoutError(TimeoutError):
+    pass
+
+
+class Retry():
+    # Timeout and retry policy of a Node. A call is abandoned after
+    # `timeout` seconds and attempted again up to `retries` times after
+    # any error, waiting backoff, 2 * backoff, 4 * backoff... in between.
+    def __init__(self, timeout: float = None, retries: int = 0, backoff: float = 0.0,
+                 max_backoff: float = None):
+        assert timeout is None or timeout > 0, Exception("Node timeout must be a positive number of seconds")
+        assert type(retries) == int and retries >= 0, Exception("Node retries must be a non negative integer")
+        assert backoff >= 0, Exception("Node backoff must not be negative")
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retried = 0
+        self.timeouts = 0
+        self.__lock__ = threading.Lock()
+
+    def __repr__(self):
+        return "Retry(timeout: {}, retries: {}, backoff: {}, retried: {}, timeouts: {})".format(
+            self.timeout, self.retries, self.backoff, self.retried, self.timeouts)
+
+    def delay(self, attempt: int):
+        delay = self.backoff * 2 ** attempt
+        return delay if self.max_backoff is None else min(delay, self.max_backoff)
+
+    def count(self, retried: int = 0, timeouts: int = 0):
+        with self.__lock__:
+            self.retried += retried
+            self.timeouts += timeouts
+
+    def timed(self, call, *args):
+        # The call runs on a thread of its own; when it times out, the
+        # caller gives up on it (and releases its Device) while the thread
+        # is left to finish in the background.
+        future = concurrent.futures.Future()
+
+        def run():
+            try:
+                future.set_result(call(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, daemon=True).start()
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            # not the builtin TimeoutError before Python 3.11
+            if future.done():
+                raise
+            self.count(timeouts=1)
+            raise NodeTimeoutError(
+                "call did not finish within {} seconds".format(self.timeout)) from None
+
+    async def atimed(self, call, *args):
+        try:
+            return await asyncio.wait_for(call(*args), self.timeout)
+        except asyncio.TimeoutError:
+            self.count(timeouts=1)
+            raise NodeTimeoutError(
+                "call did not finish within {} seconds".format(self.timeout)) from None
+
+    def stats(self):
+        return {"retries": self.retried, "timeouts": self.timeouts}
+
+    def drain(self):
+        # hands the counters over (to the parent of a worker process)
+        with self.__lock__:
+            counters = (self.retried, self.timeouts)
+            self.retried = self.timeouts = 0
+        return counters
+
+    def merge(self, counters):
+        self.count(*counters)
+
+    def __getstate__(self):
+        # copies and worker processes count from zero
+        return {k: getattr(self, k) for k in ("timeout", "retries", "backoff", "max_backoff")}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
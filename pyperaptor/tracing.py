@@ -0,0 +1,75 @@
+from collections import deque
+import threading
+import time
+import json
+import os
+
+
+class Tracer():
+    # Keeps the last `capacity` node and Device events of the pipelines it
+    # is set on, and writes them as Chrome trace JSON (chrome://tracing,
+    # https://ui.perfetto.dev).
+    def __init__(self, capacity: int = 100000, item_repr: int = 80):
+        assert capacity > 0, Exception("Tracer capacity must be a positive number of events")
+        self.capacity = capacity
+        self.item_repr = item_repr
+        self.origin = time.perf_counter()
+        self.__events__ = deque(maxlen=capacity)
+        self.__threads__ = {}
+
+    def __repr__(self):
+        return "Tracer(events: {}, capacity: {})".format(len(self.__events__), self.capacity)
+
+    def __len__(self):
+        return len(self.__events__)
+
+    def label(self, i):
+        text = repr(i)
+        return text if len(text) <= self.item_repr else text[:self.item_repr] + "..."
+
+    def complete(self, name: str, cat: str, begin: float, end: float, args: dict = None):
+        # begin and end are time.perf_counter() values
+        thread = (os.getpid(), threading.get_ident())
+        if thread not in self.__threads__:
+            self.__threads__[thread] = threading.current_thread().name
+        event = {"name": name, "cat": cat, "ph": "X",
+                 "ts": (begin - self.origin) * 1e6, "dur": (end - begin) * 1e6,
+                 "pid": thread[0], "tid": thread[1]}
+        if args:
+            event["args"] = args
+        self.__events__.append(event)
+
+    def events(self):
+        names = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                  "args": {"name": name}}
+                 for (pid, tid), name in list(self.__threads__.items())]
+        return names + list(self.__events__)
+
+    def drain(self):
+        # hands the events over (to the parent of a worker process)
+        events = self.events()
+        self.clear()
+        return events
+
+    def merge(self, events):
+        for event in events:
+            if event["ph"] == "M":
+                self.__threads__.setdefault((event["pid"], event["tid"]), event["args"]["name"])
+            else:
+                self.__events__.append(event)
+
+    def clear(self):
+        self.__events__.clear()
+        self.__threads__.clear()
+
+    def dump(self, path: str):
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events(), "displayTimeUnit": "ms"}, f)
+
+    def __getstate__(self):
+        # copies and worker processes start with an empty buffer on the same clock
+        return {"capacity": self.capacity, "item_repr": self.item_repr, "origin": self.origin}
+
+    def __setstate__(self, state):
+        self.__init__(state["capacity"], state["item_repr"])
+        self.origin = state["origin"]
@@ -1,7 +1,83 @@
+import asyncio
+import importlib.util
+import functools
+import itertools
+import json
+import random
+import tempfile
+import threading
+import time
 import unittest
 
-from pyperaptor import Device, Node, Pipeline
-from pyperaptor.pipeline import LockedPipelineError, UnlockedPipelineError
+from pyperaptor import AsyncDevice, Branch, Device, Node, Pipeline, PoolDevice, RateDevice
+from pyperaptor import NodeCache, SqliteStore, ShelfStore, MetricsHook, Tracer, NodeTimeoutError
+from pyperaptor import Autoscaler, Checkpoint
+from pyperaptor.pipeline import LockedPipelineError, UnlockedPipelineError, PipelineNodeError
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+
+def square(x):
+    return x * x
+
+
+def worker_pid(x):
+    return os.getpid()
+
+
+def batch_double(xs):
+    return [x * 2 for x in xs]
+
+
+def pair_with(x, held):
+    return (x, held)
+
+
+def plus_one(x):
+    return x + 1
+
+def connect():
+    return {"pid": os.getpid()}
+
+
+def with_connection(x, *, conn):
+    return x, conn["pid"]
+
+
+def started_at(x):
+    return time.monotonic()
+
+
+def repeat_item(x):
+    for _ in range(x):
+        yield x
+
+
+def is_even(x):
+    return x % 2 == 0
+
+
+def fail_on_three(x):
+    if x % 3 == 0:
+        raise ValueError("bad item {}".format(x))
+    return x
+
+
+_FAILED_ONCE = set()
+
+
+def fails_once(x):
+    # fails the first call for each item of the process
+    if x not in _FAILED_ONCE:
+        _FAILED_ONCE.add(x)
+        raise ConnectionError(x)
+    return x
+
+
+def append_lines(path, batch):
+    with open(path, "a") as f:
+        f.write("".join("{}\n".format(x) for x in batch))
+
 
 class TestDevice(unittest.TestCase):
     def test_device_creation(self):
@@ -310,5 +386,1512 @@ class TestNode(unittest.TestCase):
         assert result == 0
 
 
+class TestPipelinePlan(unittest.TestCase):
+    def test_lock_compiles_one_step_per_node(self):
+        def sum1(x):
+            return x + 1
+
+        p = Pipeline([sum1, sum1, sum1])
+        assert p.__plan__ == ()
+        p.lock()
+        assert len(p.__plan__) == 3
+        p.unlock()
+        assert p.__plan__ == ()
+
+    def test_plan_calls_builtins_and_callable_objects(self):
+        class Double():
+            def __call__(self, x):
+                return x * 2
+
+        p = Pipeline([Double(), abs, str])
+        p.lock()
+        assert p.push(-2) == "4"
+
+    def test_plan_refer_with_tuple_input(self):
+        def make_pair(x):
+            return (x, x + 1)
+
+        def add_all(a, b, c):
+            return a + b + c
+
+        p = Pipeline([Node(lambda x: x, hold=True, keyName="first"),
+                      make_pair,
+                      Node(add_all, refer=["first"])])
+        p.lock()
+        assert p.push(1) == 1 + 2 + 1
+
+    def test_copy_of_locked_pipeline_has_own_holding(self):
+        def sum1(x):
+            return x + 1
+
+        p = Pipeline([Node(sum1, hold=True, keyName="s")])
+        p.lock()
+        q = p.copy()
+        q.push(10)
+        p.push(1)
+        assert q.retrieve("s") == 11 and p.retrieve("s") == 2
+
+
+class TestPipelineIProcess(unittest.TestCase):
+    def test_iprocess_single_thread_is_lazy(self):
+        def sum1(x):
+            return x + 1
+
+        p = Pipeline([sum1])
+        p.lock()
+        results = p.iprocess(itertools.count())
+        assert list(itertools.islice(results, 5)) == [1, 2, 3, 4, 5]
+
+    def test_iprocess_with_generator_at_first_step(self):
+        def a_generator():
+            for x in range(10):
+                yield x
+
+        def sum1(x):
+            return x + 1
+
+        p = Pipeline([a_generator, sum1])
+        p.lock()
+        assert list(p.iprocess()) == list(range(1, 11))
+
+    def test_iprocess_multi_thread_does_not_drain_source(self):
+        pulled = []
+
+        def source():
+            for x in itertools.count():
+                pulled.append(x)
+                yield x
+
+        def identity(x):
+            return x
+
+        p = Pipeline([identity], parallel=True, workers=2)
+        p.lock()
+        results = p.iprocess(source())
+        first = list(itertools.islice(results, 10))
+        results.close()
+        assert len(first) == 10
+        assert len(pulled) < 100
+
+
+class TestPipelineBackpressure(unittest.TestCase):
+    def test_max_in_flight_stops_pulling_from_source(self):
+        pulled = []
+        release = threading.Event()
+
+        def source():
+            for x in range(100):
+                pulled.append(x)
+                yield x
+
+        def blocked(x):
+            release.wait()
+            return x
+
+        p = Pipeline([blocked], parallel=True, workers=2, max_in_flight=3)
+        p.lock()
+        results = p.iprocess(source())
+        consumer = threading.Thread(target=lambda: list(results))
+        consumer.start()
+        time.sleep(0.1)
+        assert len(pulled) == 3
+        release.set()
+        consumer.join()
+        assert len(pulled) == 100
+
+    def test_set_parallel_max_in_flight(self):
+        def identity(x):
+            return x
+
+        p = Pipeline([identity])
+        p.set_parallel(parallel=True, workers=2, max_in_flight=1)
+        p.lock()
+        assert p.__max_in_flight__ == 1
+        assert sorted(p.process(range(50))) == list(range(50))
+
+
+class TestPipelineOrdered(unittest.TestCase):
+    def test_ordered_parallel_process_keeps_input_order(self):
+        def jitter(x):
+            time.sleep(random.random() / 1000)
+            return x
+
+        p = Pipeline([jitter], parallel=True, workers=6, ordered=True)
+        p.lock()
+        assert p.process(range(200)) == list(range(200))
+
+    def test_reorder_buffer_is_bounded_by_max_in_flight(self):
+        def slow_first(x):
+            if x == 0:
+                time.sleep(0.1)
+            return x
+
+        p = Pipeline([slow_first], parallel=True, workers=4,
+                     max_in_flight=4, ordered=True)
+        p.lock()
+        assert list(p.iprocess(range(50))) == list(range(50))
+        assert 1 <= p.reorder_depth() <= 4
+
+
+class TestPipelineExecutor(unittest.TestCase):
+    def test_executor_is_reused_across_process_calls(self):
+        def thread_name(x):
+            return threading.current_thread().name
+
+        p = Pipeline([thread_name], parallel=True, workers=2)
+        p.lock()
+        pool = p.__pool__
+        first = set(p.process(range(20)))
+        second = set(p.process(range(20)))
+        assert p.__pool__ is pool
+        assert first | second <= set(t.name for t in pool._threads)
+        p.shutdown()
+        assert p.__pool__ is None
+
+    def test_context_manager_starts_and_shuts_down(self):
+        def sum1(x):
+            return x + 1
+
+        with Pipeline([sum1], parallel=True, workers=2) as p:
+            assert p.isLocked() and p.__pool__ is not None
+            assert sorted(p.process(range(5))) == [1, 2, 3, 4, 5]
+        assert p.__pool__ is None
+
+    def test_nested_parallel_pipeline_borrows_parent_executor(self):
+        def minus1(x):
+            return x - 1
+
+        def get_ten_of(x):
+            return [x] * 10
+
+        p = Pipeline([minus1], parallel=True, workers=1)
+        p.lock()
+        q = Pipeline([get_ten_of, p, sum], parallel=True, workers=1)
+        q.lock()
+        assert p.__pool__ is q.__pool__
+
+        results = []
+        runner = threading.Thread(target=lambda: results.extend(q.process([1] * 20)))
+        runner.start()
+        runner.join(5)
+        assert not runner.is_alive() and results == [0] * 20
+
+        q.shutdown()
+        assert p.__pool__ is None
+        assert p.process([1, 2]) in ([0, 1], [1, 0])
+
+
+class TestPipelineStaged(unittest.TestCase):
+    def test_staged_overlaps_stages(self):
+        def slow(x):
+            time.sleep(0.01)
+            return x + 1
+
+        p = Pipeline([slow, slow, slow], staged=True)
+        p.lock()
+        begin = time.time()
+        result = p.process(range(20))
+        elapsed = time.time() - begin
+        assert result == list(range(3, 23))
+        assert elapsed < 0.45
+
+    def test_staged_node_workers(self):
+        def a_generator():
+            for x in range(40):
+                yield x
+
+        def slow(x):
+            time.sleep(0.01)
+            return x * 2
+
+        p = Pipeline([a_generator, Node(slow, workers=8)], staged=True, ordered=True)
+        p.lock()
+        begin = time.time()
+        assert p.process() == [x * 2 for x in range(40)]
+        assert time.time() - begin < 0.3
+        assert p.reorder_depth() >= 1
+
+    def test_staged_raises_node_errors(self):
+        def fail_on_three(x):
+            if x == 3:
+                raise ValueError(x)
+            return x
+
+        p = Pipeline([fail_on_three], staged=True, queue_size=2)
+        p.lock()
+        with self.assertRaises(ValueError):
+            p.process(range(100))
+
+    def test_staged_iprocess_can_stop_early(self):
+        def identity(x):
+            return x
+
+        p = Pipeline([identity, identity], staged=True, queue_size=1)
+        p.lock()
+        results = p.iprocess(itertools.count())
+        assert len(list(itertools.islice(results, 10))) == 10
+        results.close()
+
+
+class TestPipelineAsync(unittest.TestCase):
+    def test_aprocess_runs_coroutines_concurrently(self):
+        async def fetch(x):
+            await asyncio.sleep(0.05)
+            return x
+
+        def sum1(x):
+            return x + 1
+
+        p = Pipeline([fetch, sum1])
+        p.lock()
+        begin = time.time()
+        result = asyncio.run(p.aprocess(range(500), concurrency=500))
+        assert sorted(result) == list(range(1, 501))
+        assert time.time() - begin < 2
+
+    def test_aiter_process_with_async_generator(self):
+        async def a_generator():
+            for x in range(10):
+                yield x
+
+        async def double(x):
+            return x * 2
+
+        p = Pipeline([a_generator, double], parallel=True, workers=2, ordered=True)
+        p.lock()
+
+        async def collect():
+            return [r async for r in p.aiter_process()]
+
+        assert asyncio.run(collect()) == [x * 2 for x in range(10)]
+
+    def test_async_device_limits_concurrency(self):
+        running = [0, 0]
+
+        async def limited(x):
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+            await asyncio.sleep(0.01)
+            running[0] -= 1
+            return x
+
+        p = Pipeline([Node(limited, dev=AsyncDevice("api", 3))])
+        p.lock()
+        asyncio.run(p.aprocess(range(30), concurrency=30))
+        assert running[1] == 3
+        # a new event loop gets a semaphore of its own
+        running[1] = 0
+        asyncio.run(p.aprocess(range(30), concurrency=30))
+        assert running[1] == 3
+
+    def test_device_waits_on_the_event_loop(self):
+        # sync nodes run on the default executor; waiting there for the
+        # Device would take the threads that release it
+        dev = Device("db", 1)
+
+        def work(x):
+            time.sleep(0.001)
+            return x
+
+        def run():
+            p = Pipeline([Node(work, dev=dev)])
+            p.lock()
+            done.append(sorted(asyncio.run(p.aprocess(range(50), concurrency=50))))
+
+        done = []
+        t = threading.Thread(target=run, daemon=True)
+        t.start()
+        t.join(10)
+        assert done == [list(range(50))]
+
+    def test_cancelled_waiters_leave_the_device_free(self):
+        dev = Device("db", 1)
+
+        async def fail_on_three(x):
+            if x == 3:
+                raise ValueError(x)
+            await asyncio.sleep(0.001)
+            return x
+
+        def slow(x):
+            time.sleep(0.01)
+            return x
+
+        p = Pipeline([fail_on_three, Node(slow, dev=dev)])
+        p.lock()
+        for _ in range(3):
+            with self.assertRaises(ValueError):
+                asyncio.run(p.aprocess(range(20), concurrency=10))
+            assert dev.__sem__.acquire(False)
+            dev.release()
+
+    def test_device_hands_slots_to_waiters(self):
+        # 300 waiters on one slot: each release wakes the next one at once
+        dev = Device("db", 1)
+
+        async def work(x):
+            await asyncio.sleep(0.001)
+            return x
+
+        p = Pipeline([Node(work, dev=dev)])
+        p.lock()
+        begin = time.monotonic()
+        assert sorted(asyncio.run(p.aprocess(range(300), concurrency=300))) == list(range(300))
+        assert time.monotonic() - begin < 1.5
+        assert dev.__sem__.acquire(False)
+        dev.release()
+
+    def test_push_with_coroutine_node(self):
+        async def sum1(x):
+            return x + 1
+
+        p = Pipeline([sum1, sum1])
+        p.lock()
+        assert p.push(1) == 3
+        assert asyncio.run(p.apush(1)) == 3
+
+
+class TestPipelineProcessPool(unittest.TestCase):
+    def test_process_pool_runs_chunks_in_workers(self):
+        p = Pipeline([square, worker_pid], parallel=True, workers=2,
+                     executor=ProcessPoolExecutor, chunksize=10)
+        p.lock()
+        try:
+            assert p.is_multiprocess()
+            pids = p.process(range(100))
+            assert len(pids) == 100 and os.getpid() not in pids
+        finally:
+            p.shutdown()
+
+    def test_process_pool_ordered_with_device(self):
+        p = Pipeline([Node(square, dev=Device("cpu", 2)), square], parallel=True,
+                     workers=2, executor=ProcessPoolExecutor, chunksize=7, ordered=True)
+        with p:
+            assert p.process(range(50)) == [x ** 4 for x in range(50)]
+            assert list(p.iprocess(range(5))) == [0, 1, 16, 81, 256]
+
+    def test_settings_changed_after_lock_reach_the_workers(self):
+        p = Pipeline([fail_on_three], parallel=True, workers=2,
+                     executor=ProcessPoolExecutor, ordered=True)
+        with p:
+            with self.assertRaises(ValueError):
+                p.process(range(5))
+            p.set_errors("capture")
+            p.set_metrics()
+            assert p.process(range(5)) == [1, 2, 4]
+            assert [f.item for f in p.failures] == [0, 3]
+            assert p.stats()["0:fail_on_three"]["calls"] == 5
+            p.set_errors("raise")
+            with self.assertRaises(ValueError):
+                p.process(range(5))
+
+
+class TestBatchNode(unittest.TestCase):
+    def test_batch_node_receives_lists(self):
+        sizes = []
+
+        def double(xs):
+            sizes.append(len(xs))
+            return [x * 2 for x in xs]
+
+        def sum1(x):
+            return x + 1
+
+        p = Pipeline([sum1, Node(double, batch_size=4), sum1])
+        p.lock()
+        assert p.process(range(10)) == [(x + 1) * 2 + 1 for x in range(10)]
+        assert sizes == [4, 4, 2]
+        assert p.push(1) == 5
+
+    def test_batch_node_in_parallel_modes(self):
+        def sum1(x):
+            return x + 1
+
+        expected = [(x + 1) * 2 for x in range(50)]
+        for kwargs in ({"parallel": True, "workers": 3, "ordered": True},
+                       {"staged": True, "ordered": True}):
+            p = Pipeline([sum1, Node(batch_double, batch_size=8)], **kwargs)
+            p.lock()
+            assert p.process(range(50)) == expected
+            p.shutdown()
+
+        p = Pipeline([Node(batch_double, batch_size=8), square], parallel=True,
+                     workers=2, executor=ProcessPoolExecutor, chunksize=20, ordered=True)
+        with p:
+            assert p.process(range(50)) == [(x * 2) ** 2 for x in range(50)]
+
+        p = Pipeline([sum1, Node(batch_double, batch_size=8)], ordered=True)
+        p.lock()
+        assert asyncio.run(p.aprocess(range(50), concurrency=4)) == expected
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy"), "requires numpy")
+    def test_batch_node_stacks_arrays(self):
+        import numpy
+
+        def normalize(batch):
+            return batch / batch.sum(axis=1, keepdims=True)
+
+        p = Pipeline([Node(normalize, batch_size=16, stack=True)])
+        p.lock()
+        result = p.process([numpy.ones(4)] * 20)
+        assert len(result) == 20 and numpy.allclose(result[0], 0.25)
+
+    def test_batch_node_result_size_must_match(self):
+        p = Pipeline([Node(lambda xs: xs[:1], batch_size=3)])
+        p.lock()
+        with self.assertRaises(PipelineNodeError):
+            p.process(range(3))
+
+
+class TestHoldRefer(unittest.TestCase):
+    def test_refer_in_every_mode(self):
+        expected = [((x + 1) * 2, x + 1) for x in range(100)]
+        for kwargs in ({}, {"parallel": True, "workers": 8}, {"staged": True},
+                       {"parallel": True, "workers": 2, "executor": ProcessPoolExecutor}):
+            nodes = [Node(plus_one, hold=True, keyName="plus"),
+                     Node(batch_double, batch_size=4),
+                     Node(pair_with, refer=["plus"])]
+            with Pipeline(nodes, ordered=True, **kwargs) as p:
+                assert p.process(range(100)) == expected
+
+        p = Pipeline([Node(plus_one, hold=True, keyName="plus"),
+                      Node(pair_with, refer=["plus"])], parallel=True, ordered=True)
+        p.lock()
+        assert asyncio.run(p.aprocess(range(10), concurrency=5)) == \
+            [(x + 1, x + 1) for x in range(10)]
+
+    def test_push_publishes_held_values(self):
+        def sum1(x):
+            return x + 1
+
+        p = Pipeline([Node(sum1, hold=True, keyName="plus"), sum1])
+        p.lock()
+        assert p.push(1) == 3
+        assert p.retrieve("plus") == 2
+
+    def test_refer_to_value_held_by_pipeline(self):
+        p = Pipeline([Node(pair_with, refer=["constant"])])
+        p.hold("constant", 42)
+        p.lock()
+        assert p.process([1, 2]) == [(1, 42), (2, 42)]
+
+    def test_process_publishes_held_values(self):
+        p = Pipeline([Node(lambda x: x * 2, hold=True, keyName="a"), plus_one])
+        p.lock()
+        assert p.process([1, 2, 3]) == [3, 5, 7]
+        assert p.retrieve("a") == 6
+
+    def test_refer_to_the_previous_item(self):
+        p = Pipeline([Node(lambda x, total: x + total, refer=["a"]),
+                      Node(lambda x: x, hold=True, keyName="a")])
+        p.hold("a", 0)
+        p.lock()
+        assert p.process([1, 2, 3]) == [1, 3, 6]
+        assert p.retrieve("a") == 6
+
+    def test_refer_before_hold_is_an_error_in_parallel(self):
+        for kwargs in ({"parallel": True}, {"staged": True},
+                       {"parallel": True, "executor": ProcessPoolExecutor}):
+            p = Pipeline([Node(pair_with, refer=["later"]),
+                          Node(lambda x: x, hold=True, keyName="later")], **kwargs)
+            p.hold("later", 0)
+            with self.assertRaises(PipelineNodeError):
+                p.lock()
+
+
+class TestNodeCache(unittest.TestCase):
+    def test_lru_eviction_and_counters(self):
+        calls = []
+
+        def square_logged(x):
+            calls.append(x)
+            return x * x
+
+        cache = NodeCache(maxsize=2)
+        p = Pipeline([Node(square_logged, cache=cache)])
+        p.lock()
+        assert p.process([1, 2, 1, 3, 2, 1]) == [1, 4, 1, 9, 4, 1]
+        assert calls == [1, 2, 3, 2, 1]
+        assert cache.stats() == {"hits": 1, "misses": 5, "evictions": 3, "size": 2}
+
+    def test_ttl_and_key_function(self):
+        cache = NodeCache(ttl=0.05, key=lambda s: s.lower())
+        p = Pipeline([Node(str.upper, cache=cache)])
+        p.lock()
+        assert p.process(["a", "A"]) == ["A", "A"]
+        assert cache.hits == 1
+        time.sleep(0.06)
+        p.push("a")
+        assert cache.misses == 2
+
+    def test_key_function_with_refer(self):
+        keyed = []
+
+        def lower(url):
+            keyed.append(url)
+            return url.lower()
+
+        cache = NodeCache(key=lower)
+        p = Pipeline([Node(lambda url, prefix: prefix + url, refer=["prefix"], cache=cache)])
+        p.hold("prefix", "get ")
+        p.lock()
+        assert p.process(["A", "a"]) == ["get A", "get A"]
+        assert keyed == ["A", "a"] and cache.hits == 1
+        p.hold("prefix", "put ")
+        assert p.push("a") == "put a"
+        assert cache.misses == 2
+
+    def test_cache_in_parallel_and_batch_nodes(self):
+        calls = []
+
+        def double(xs):
+            calls.extend(xs)
+            return [x * 2 for x in xs]
+
+        p = Pipeline([Node(double, batch_size=4, cache=True)],
+                     parallel=True, workers=4, ordered=True)
+        p.lock()
+        assert p.process([1, 2, 3, 4] * 10) == [2, 4, 6, 8] * 10
+        assert len(calls) < 40
+
+    def test_persistent_stores(self):
+        folder = tempfile.mkdtemp()
+        for store in (SqliteStore(os.path.join(folder, "cache.db")),
+                      ShelfStore(os.path.join(folder, "cache.shelf"))):
+            first = NodeCache(store=store)
+            first.put("key", [1, 2])
+            second = NodeCache(store=store)
+            assert second.get("key") == [1, 2] and second.hits == 1
+            store.close()
+
+
+class TestCoalesce(unittest.TestCase):
+    def test_duplicates_share_one_call(self):
+        calls = []
+        device = Device("backend", 1)
+
+        def expensive(x):
+            calls.append(x)
+            time.sleep(0.05)
+            return x * 10
+
+        node = Node(expensive, dev=device, coalesce_key=lambda x: x % 2)
+        p = Pipeline([node], parallel=True, workers=8)
+        p.lock()
+        result = p.process([1, 3, 5, 7, 2, 4, 6, 8])
+        assert len(calls) == 2
+        assert sorted(result) == sorted(x * 10 for x in calls for _ in range(4))
+        assert node.get_flight().shared == 6
+
+    def test_waiters_get_the_leader_error(self):
+        def fail(x):
+            time.sleep(0.05)
+            raise ValueError(x)
+
+        node = Node(fail, coalesce_key=True)
+        p = Pipeline([node], parallel=True, workers=4)
+        p.lock()
+        with self.assertRaises(ValueError):
+            p.process([1, 1, 1, 1])
+
+    def test_async_coalesce(self):
+        calls = []
+
+        async def fetch(x):
+            calls.append(x)
+            await asyncio.sleep(0.02)
+            return x
+
+        p = Pipeline([Node(fetch, coalesce_key=True)])
+        p.lock()
+        assert asyncio.run(p.aprocess([7] * 20, concurrency=20)) == [7] * 20
+        assert calls == [7]
+
+    def test_unhashable_keys_are_not_coalesced(self):
+        node = Node(sum, coalesce_key=True)
+        p = Pipeline([node], parallel=True, workers=4)
+        p.lock()
+        assert sorted(p.process([[1, 2], [1, 2], [3]])) == [3, 3, 3]
+        assert node.get_flight().shared == 0
+
+        async def total(x):
+            return sum(x)
+
+        p = Pipeline([Node(total, coalesce_key=True)])
+        p.lock()
+        assert asyncio.run(p.aprocess([[1, 2], [3]])) == [3, 3]
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counts_and_percentiles(self):
+        def fail_odd(x):
+            if x % 2:
+                raise ValueError(x)
+            return x
+
+        p = Pipeline([square, fail_odd], metrics=True)
+        p.lock()
+        for i in range(10):
+            try:
+                p.push(i)
+            except ValueError:
+                pass
+        stats = p.stats()
+        assert stats["0:square"]["calls"] == 10
+        assert stats["0:square"]["errors"] == 0
+        assert stats["1:fail_odd"]["calls"] == 10
+        assert stats["1:fail_odd"]["errors"] == 5
+        assert 0 < stats["0:square"]["p50"] <= stats["0:square"]["p99"]
+
+    def test_device_wait_and_hooks(self):
+        calls = []
+
+        class Recorder(MetricsHook):
+            def on_call(self, node, latency, wait, error):
+                calls.append((node, wait))
+
+        def slow(x):
+            time.sleep(0.02)
+            return x
+
+        p = Pipeline([Node(slow, dev=Device("one", 1))], parallel=True, workers=4)
+        p.add_hook(Recorder())
+        p.lock()
+        p.process(range(8))
+        stats = p.stats()["0:slow"]
+        assert stats["calls"] == 8 and len(calls) == 8
+        assert stats["device_wait"] > 0.02
+        assert stats["executing"] >= 8 * 0.02
+
+    def test_disabled_leaves_the_plan_unwrapped(self):
+        p = Pipeline([square])
+        p.lock()
+        assert "_with_metrics" not in p.__plan__[0].__qualname__
+        assert p.stats() == {"0:square": {}}
+        p.set_metrics()
+        assert "_with_metrics" in p.__plan__[0].__qualname__
+
+    def test_process_pool_metrics_are_merged(self):
+        p = Pipeline([square], parallel=True, workers=2,
+                     executor=ProcessPoolExecutor, chunksize=4, metrics=True)
+        with p:
+            assert sorted(p.process(range(20))) == [x * x for x in range(20)]
+        assert p.stats()["0:square"]["calls"] == 20
+
+
+class TestTracer(unittest.TestCase):
+    def test_node_and_device_events(self):
+        tracer = Tracer()
+        p = Pipeline([square, Node(plus_one, dev=Device("gpu", 1))], parallel=True, workers=3)
+        p.set_tracer(tracer)
+        p.lock()
+        p.process(range(6))
+        events = tracer.events()
+        nodes = [e for e in events if e.get("cat") == "node"]
+        assert len(nodes) == 12
+        assert {e["name"] for e in nodes} == {"0:square", "1:plus_one"}
+        assert sorted(e["args"]["item"] for e in nodes if e["name"] == "0:square") == \
+            [repr(i) for i in range(6)]
+        devices = [e["name"] for e in events if e.get("cat") == "device"]
+        assert devices.count("acquire gpu") == 6 and devices.count("gpu") == 6
+        assert any(e["ph"] == "M" for e in events)
+
+    def test_ring_buffer_and_dump(self):
+        tracer = Tracer(capacity=5)
+        p = Pipeline([square])
+        p.set_tracer(tracer)
+        p.lock()
+        p.process(range(20))
+        assert len(tracer) == 5
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trace.json")
+            tracer.dump(path)
+            with open(path) as f:
+                trace = json.load(f)
+        assert len([e for e in trace["traceEvents"] if e["ph"] == "X"]) == 5
+
+    def test_nested_pipelines_share_the_tracer(self):
+        tracer = Tracer()
+        sub = Pipeline([square])
+        sub.lock()
+        p = Pipeline([plus_one, sub])
+        p.set_tracer(tracer)
+        p.lock()
+        assert p.push(2) == 9
+        assert sub.get_tracer() is tracer
+        assert sorted(e["name"] for e in tracer.events() if e["ph"] == "X") == \
+            ["0:plus_one", "0:square", "1:Pipeline"]
+
+    def test_process_pool_events_are_merged(self):
+        tracer = Tracer()
+        p = Pipeline([square], parallel=True, workers=2,
+                     executor=ProcessPoolExecutor, chunksize=5)
+        p.set_tracer(tracer)
+        with p:
+            p.process(range(20))
+        nodes = [e for e in tracer.events() if e["ph"] == "X"]
+        assert len(nodes) == 20
+        assert os.getpid() not in {e["pid"] for e in nodes}
+
+
+class TestPoolDevice(unittest.TestCase):
+    def test_resources_are_created_lazily_and_reused(self):
+        in_use = set()
+        lock = threading.Lock()
+
+        def query(x, conn):
+            with lock:
+                assert id(conn) not in in_use
+                in_use.add(id(conn))
+            time.sleep(0.01)
+            with lock:
+                in_use.discard(id(conn))
+            return x
+
+        pool = PoolDevice("db", factory=lambda: object(), number=2, keyword="conn")
+        p = Pipeline([Node(query, dev=pool)], parallel=True, workers=6)
+        p.lock()
+        assert sorted(p.process(range(20))) == list(range(20))
+        assert pool.created <= 2
+        assert pool.idle() == pool.created
+
+    def test_resource_list_and_single_mode(self):
+        pool = PoolDevice("files", resources=["a", "b"])
+        p = Pipeline([Node(lambda x, resource: x + resource, dev=pool)])
+        p.lock()
+        assert p.process(["1", "2"]) == ["1b", "2b"]
+        assert pool.number == 2 and pool.created == 0
+
+    def test_health_check_and_max_idle(self):
+        closed = []
+        pool = PoolDevice("db", factory=lambda: {"ok": True}, check=lambda c: c["ok"],
+                          close=closed.append)
+        conn = pool.checkout()
+        pool.checkin(conn)
+        conn["ok"] = False
+        assert pool.checkout() is not conn
+        assert closed == [conn] and pool.created == 2
+
+        pool = PoolDevice("db", factory=object, max_idle=0.01)
+        conn = pool.checkout()
+        pool.checkin(conn)
+        time.sleep(0.02)
+        assert pool.checkout() is not conn
+
+    def test_list_without_factory_runs_out(self):
+        pool = PoolDevice("db", resources=[1], check=lambda c: False)
+        with self.assertRaises(PipelineNodeError):
+            pool.checkout()
+
+    def test_list_without_factory_is_never_short(self):
+        with self.assertRaises(AssertionError):
+            PoolDevice("gpu", resources=["ctx0", "ctx1"], max_idle=0.05)
+        with self.assertRaises(AssertionError):
+            PoolDevice("gpu", resources=["ctx0", "ctx1"], number=3)
+
+        pool = PoolDevice("gpu", resources=["ctx0", "ctx1"])
+        p = Pipeline([Node(lambda x, resource: resource, dev=pool)], parallel=True, workers=4)
+        with p:
+            assert set(p.process(range(8))) <= {"ctx0", "ctx1"}
+            time.sleep(0.1)
+            assert len(p.process(range(8))) == 8
+
+    def test_async_node(self):
+        async def query(x, resource):
+            await asyncio.sleep(0.001)
+            return x * resource
+
+        pool = PoolDevice("db", resources=[10, 10])
+        p = Pipeline([Node(query, dev=pool)])
+        p.lock()
+        assert sorted(asyncio.run(p.aprocess(range(5)))) == [0, 10, 20, 30, 40]
+
+    def test_process_pool_workers_own_their_pool(self):
+        pool = PoolDevice("db", factory=connect, keyword="conn")
+        p = Pipeline([Node(with_connection, dev=pool)], parallel=True, workers=2,
+                     executor=ProcessPoolExecutor, chunksize=2)
+        with p:
+            result = p.process(range(8))
+        assert sorted(x for x, _ in result) == list(range(8))
+        assert os.getpid() not in {pid for _, pid in result}
+
+
+class TestRateDevice(unittest.TestCase):
+    def test_thread_mode_keeps_the_rate(self):
+        device = RateDevice("api", rate=100, burst=5)
+        p = Pipeline([Node(started_at, dev=device)], parallel=True, workers=8)
+        p.lock()
+        begin = time.monotonic()
+        starts = sorted(p.process(range(25)))
+        # 5 calls from the burst, 20 more at 100 per second
+        assert starts[-1] - begin >= 0.19
+        assert all(t - begin >= (k + 1) * 0.01 - 0.001 for k, t in enumerate(starts[5:]))
+        assert device.throttled > 0
+
+    def test_single_mode_and_push(self):
+        device = RateDevice("api", rate=100, burst=1)
+        p = Pipeline([Node(started_at, dev=device)])
+        p.lock()
+        begin = time.monotonic()
+        starts = p.process(range(6)) + [p.push(0) for _ in range(5)]
+        assert starts[-1] - begin >= 0.095
+        assert all(t - begin >= k * 0.01 - 0.001 for k, t in enumerate(starts))
+
+        batch = Pipeline([Node(lambda xs: [time.monotonic()] * len(xs), dev=device, batch_size=2)])
+        batch.lock()
+        begin = time.monotonic()
+        starts = batch.process(range(6))
+        assert starts[-1] - begin >= 0.015
+
+    def test_async_mode_and_delay(self):
+        device = RateDevice("api", rate=200, burst=1)
+
+        async def call(x):
+            return time.monotonic()
+
+        p = Pipeline([Node(call, dev=device)])
+        p.lock()
+        begin = time.monotonic()
+        starts = asyncio.run(p.aprocess(range(11), concurrency=11))
+        assert max(starts) - begin >= 0.045
+        time.sleep(0.01)
+        assert device.delay() == 0.0
+        device.get()
+        assert 0 < device.delay() <= 0.005
+
+    def test_concurrency_limit(self):
+        running = []
+        device = RateDevice("api", rate=1000, burst=10, number=2)
+
+        def work(x):
+            running.append(1)
+            assert len(running) <= 2
+            time.sleep(0.01)
+            running.pop()
+            return x
+
+        p = Pipeline([Node(work, dev=device)], parallel=True, workers=6)
+        p.lock()
+        assert sorted(p.process(range(10))) == list(range(10))
+
+    def test_process_pool_shares_the_bucket(self):
+        device = RateDevice("api", rate=100, burst=1)
+        p = Pipeline([Node(started_at, dev=device)], parallel=True, workers=3,
+                     executor=ProcessPoolExecutor, chunksize=2)
+        with p:
+            starts = sorted(p.process(range(12)))
+        assert starts[-1] - starts[0] >= 0.1
+
+
+class TestSinkNode(unittest.TestCase):
+    def test_flush_by_size_and_at_the_end(self):
+        batches = []
+        p = Pipeline([square, Node(batches.append, flush_size=4)])
+        p.lock()
+        assert p.process(range(10)) == [x * x for x in range(10)]
+        assert [len(b) for b in batches] == [4, 4, 2]
+        assert sum(batches, []) == [x * x for x in range(10)]
+
+    def test_flush_by_time(self):
+        batches = []
+        p = Pipeline([Node(batches.append, flush_size=100, flush_ms=20)])
+        p.lock()
+        p.push(1)
+        p.push(2)
+        assert batches == []
+        time.sleep(0.1)
+        assert batches == [[1, 2]]
+
+    def test_parallel_workers_and_shutdown(self):
+        batches = []
+        lock = threading.Lock()
+
+        def write(batch):
+            assert lock.acquire(blocking=False), "bulk calls overlap"
+            time.sleep(0.001)
+            batches.append(batch)
+            lock.release()
+
+        node = Node(write, dev=Device("db", 1), flush_size=7)
+        with Pipeline([plus_one, node], parallel=True, workers=8) as p:
+            for _ in p.iprocess(range(100)):
+                pass
+            assert sorted(sum(batches, [])) == list(range(1, 101))
+            assert all(len(b) <= 7 for b in batches)
+            p.push(1000)
+            assert len(node.get_sink()) == 1
+        assert batches[-1] == [1001]
+
+    def test_async_and_errors(self):
+        def fail(batch):
+            raise IOError("disk full")
+
+        p = Pipeline([Node(fail, flush_size=3)])
+        p.lock()
+        with self.assertRaises(IOError):
+            asyncio.run(p.aprocess(range(2)))
+
+        p = Pipeline([Node(len, dev=AsyncDevice("db"), flush_size=3)])
+        with self.assertRaises(PipelineNodeError):
+            p.lock()
+
+    def test_process_pool_flushes_every_chunk(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "out.txt")
+            p = Pipeline([square, Node(functools.partial(append_lines, path), flush_size=100)],
+                         parallel=True, workers=2, executor=ProcessPoolExecutor, chunksize=5)
+            with p:
+                p.process(range(20))
+            with open(path) as f:
+                assert sorted(int(x) for x in f.read().split()) == [x * x for x in range(20)]
+
+
+class TestFlatMapFilter(unittest.TestCase):
+    def expected(self, items):
+        return [y * y for x in items if x % 2 == 0 for y in [x] * x]
+
+    def pipeline(self, **kwargs):
+        return Pipeline([Node(is_even, kind="filter"),
+                         Node(repeat_item, kind="flatmap"),
+                         square], **kwargs)
+
+    def test_every_mode(self):
+        items = list(range(10))
+        modes = [{}, {"parallel": True, "workers": 4, "ordered": True},
+                 {"staged": True, "ordered": True},
+                 {"parallel": True, "workers": 2, "executor": ProcessPoolExecutor,
+                  "ordered": True}]
+        for kwargs in modes:
+            with self.pipeline(**kwargs) as p:
+                assert p.process(items) == self.expected(items), kwargs
+
+        p = self.pipeline()
+        p.lock()
+        assert asyncio.run(p.aprocess(items, concurrency=4)) == self.expected(items)
+
+    def test_expansion_is_lazy(self):
+        produced = []
+
+        def numbers(limit):
+            for i in itertools.count():
+                produced.append(i)
+                yield i
+
+        p = Pipeline([Node(numbers, kind="flatmap"), plus_one])
+        p.lock()
+        assert list(itertools.islice(p.iprocess([1]), 3)) == [1, 2, 3]
+        assert len(produced) <= 4
+
+    def test_expansion_runs_on_workers_holding_the_device(self):
+        active, peak, threads = [0], [0], set()
+        lock = threading.Lock()
+
+        def slow_range(n):
+            for i in range(n):
+                with lock:
+                    active[0] += 1
+                    peak[0] = max(peak[0], active[0])
+                    threads.add(threading.current_thread())
+                time.sleep(0.002)
+                with lock:
+                    active[0] -= 1
+                yield i
+
+        p = Pipeline([Node(slow_range, kind="flatmap", dev=Device("flat", 1)), plus_one],
+                     parallel=True, workers=4, metrics=True)
+        with p:
+            assert sorted(p.process([10] * 6)) == sorted(list(range(1, 11)) * 6)
+        assert peak[0] == 1
+        assert threading.current_thread() not in threads
+        stats = p.stats()["0:slow_range"]
+        assert stats["calls"] > 6 and stats["p50"] > 0
+
+    def test_expansion_is_retried_until_its_first_outputs(self):
+        attempts = []
+
+        def flaky(x):
+            attempts.append(x)
+            if len(attempts) == 1:
+                raise ValueError(x)
+            yield x
+            if len(attempts) == 2:
+                raise KeyError(x)
+            yield x + 1
+
+        p = Pipeline([Node(flaky, kind="flatmap", retries=2)], errors="capture")
+        p.lock()
+        assert p.process([5]) == [5]
+        assert len(attempts) == 2
+        assert [(f.item, type(f.error)) for f in p.failures] == [(5, KeyError)]
+
+    def test_dropped_items_skip_later_nodes(self):
+        seen = []
+
+        def record(x):
+            seen.append(x)
+            return x
+
+        p = Pipeline([Node(is_even, kind="filter"), record,
+                      Node(lambda xs: [x * 10 for x in xs], batch_size=3)],
+                     parallel=True, workers=3, ordered=True)
+        p.lock()
+        assert p.process(range(10)) == [0, 20, 40, 60, 80]
+        assert sorted(seen) == [0, 2, 4, 6, 8]
+
+    def test_push(self):
+        p = self.pipeline()
+        p.lock()
+        assert p.push(3) == []
+        assert p.push(2) == [4, 4]
+
+        f = Pipeline([Node(is_even, kind="filter"), plus_one])
+        f.lock()
+        assert f.push(3) is None
+        assert f.push(2) == 3
+
+    def test_outputs_get_their_own_context(self):
+        p = Pipeline([Node(lambda x: [x, x + 1], kind="flatmap"),
+                      Node(plus_one, hold=True, keyName="plus"),
+                      Node(pair_with, refer=["plus"])], staged=True, ordered=True)
+        p.lock()
+        assert p.process([1, 10]) == [(2, 2), (3, 3), (11, 11), (12, 12)]
+
+    def test_invalid_kinds(self):
+        with self.assertRaises(AssertionError):
+            Node(square, kind="reduce")
+        p = Pipeline([Node(repeat_item, kind="flatmap", cache=True)])
+        with self.assertRaises(PipelineNodeError):
+            p.lock()
+
+
+class TestBranch(unittest.TestCase):
+    def slow(self, value):
+        def branch(x):
+            time.sleep(0.05)
+            return x + value
+        return branch
+
+    def test_branches_run_concurrently(self):
+        p = Pipeline([Branch(self.slow(1), self.slow(2), Pipeline([self.slow(3), square])),
+                      lambda a, b, c: a + b + c])
+        p.lock()
+        begin = time.monotonic()
+        assert p.push(1) == 2 + 3 + 16
+        assert time.monotonic() - begin < 0.14
+        p.shutdown()
+
+    def test_named_branches_in_parallel_mode(self):
+        p = Pipeline([plus_one, Branch(square=square, same=lambda x: x)],
+                     parallel=True, workers=2, ordered=True)
+        with p:
+            assert p.process(range(3)) == [{"square": 1, "same": 1},
+                                           {"square": 4, "same": 2},
+                                           {"square": 9, "same": 3}]
+
+    def test_saturated_pool_does_not_deadlock(self):
+        p = Pipeline([Branch(self.slow(0), self.slow(0), self.slow(0))],
+                     parallel=True, workers=2)
+        with p:
+            assert len(p.process(range(8))) == 8
+
+    def test_async_branches(self):
+        async def fetch(x):
+            await asyncio.sleep(0.05)
+            return x * 10
+
+        p = Pipeline([Branch(fetch, fetch, square)])
+        p.lock()
+        begin = time.monotonic()
+        assert asyncio.run(p.aprocess([2, 3], concurrency=2)) == [(20, 20, 4), (30, 30, 9)]
+        assert time.monotonic() - begin < 0.09
+
+    def test_process_pool_and_errors(self):
+        p = Pipeline([Branch(square, plus_one)], parallel=True, workers=2,
+                     executor=ProcessPoolExecutor, ordered=True)
+        with p:
+            assert p.process(range(4)) == [(0, 1), (1, 2), (4, 3), (9, 4)]
+
+        def fail(x):
+            raise ValueError(x)
+
+        p = Pipeline([Branch(square, fail)])
+        p.lock()
+        with self.assertRaises(ValueError):
+            p.push(1)
+        p.shutdown()
+
+
+class TestErrorModes(unittest.TestCase):
+    def test_fail_fast_stops_the_source(self):
+        pulled = []
+
+        def source():
+            for i in itertools.count():
+                pulled.append(i)
+                yield i
+
+        def work(x):
+            if x == 0:
+                time.sleep(0.5)
+            if x == 3:
+                raise ValueError(x)
+            return x
+
+        for ordered in (False, True):
+            pulled.clear()
+            p = Pipeline([work], parallel=True, workers=4, max_in_flight=8, ordered=ordered)
+            with p:
+                begin = time.monotonic()
+                with self.assertRaises(ValueError):
+                    p.process(source())
+                assert time.monotonic() - begin < 0.4
+            assert len(pulled) <= 12
+
+    def test_capture_keeps_the_stream_flowing(self):
+        modes = [{}, {"parallel": True, "workers": 3, "ordered": True},
+                 {"staged": True, "ordered": True},
+                 {"parallel": True, "workers": 2, "executor": ProcessPoolExecutor,
+                  "ordered": True}]
+        for kwargs in modes:
+            p = Pipeline([plus_one, fail_on_three, square], errors="capture", **kwargs)
+            with p:
+                assert p.process(range(8)) == [1, 4, 16, 25, 49, 64], kwargs
+            assert sorted(f.item for f in p.failures) == [3, 6], kwargs
+            assert sorted(f.source for f in p.failures) == [2, 5], kwargs
+            assert all(f.node == "1:fail_on_three" for f in p.failures)
+            assert "bad item" in p.failures[0].traceback
+            assert isinstance(p.failures[0].error, ValueError)
+
+    def test_error_sink_async_and_batches(self):
+        captured = []
+        p = Pipeline([fail_on_three], errors="capture")
+        p.set_errors("capture", sink=captured.append)
+        p.lock()
+        assert asyncio.run(p.aprocess(range(5))) == [1, 2, 4]
+        assert [f.item for f in captured] == [0, 3]
+        assert p.push(3) is None and len(captured) == 3
+
+        def batch_fail(xs):
+            if 4 in xs:
+                raise ValueError(xs)
+            return xs
+
+        p = Pipeline([Node(batch_fail, batch_size=2)], errors="capture")
+        p.lock()
+        assert p.process(range(6)) == [0, 1, 2, 3]
+        assert [f.item for f in p.failures] == [4, 5]
+
+    def test_failures_record_the_source_item(self):
+        def batch_fail(xs):
+            if 40 in xs:
+                raise ValueError(xs)
+            return xs
+
+        p = Pipeline([Node(plus_one, hold=True, keyName="plus"),
+                      Node(lambda x: [x, x * 10], kind="flatmap"),
+                      Node(batch_fail, batch_size=2),
+                      Node(pair_with, refer=["plus"])],
+                     errors="capture")
+        with p:
+            assert p.process([2, 3]) == [(3, 3), (30, 3)]
+        assert [(f.item, f.source) for f in p.failures] == [(4, 3), (40, 3)]
+        p.failures.clear()
+        assert asyncio.run(p.apush(3)) == []
+        assert [(f.item, f.source) for f in p.failures] == [(4, 3), (40, 3)]
+
+        p = Pipeline([plus_one, fail_on_three], errors="capture")
+        p.lock()
+        p.push(2)
+        assert [(f.item, f.source) for f in p.failures] == [(3, 2)]
+        assert p.process([f.source + 1 for f in p.failures]) == [4]
+
+
+class TestTimeoutRetry(unittest.TestCase):
+    def test_retries_with_backoff(self):
+        calls = []
+
+        def flaky(x):
+            calls.append(time.monotonic())
+            if len(calls) < 3:
+                raise ConnectionError(x)
+            return x
+
+        p = Pipeline([Node(flaky, retries=3, backoff=0.05)])
+        p.lock()
+        assert p.push(7) == 7
+        assert calls[1] - calls[0] >= 0.05 and calls[2] - calls[1] >= 0.1
+        assert p.stats()["0:flaky"] == {"retries": 2, "timeouts": 0}
+
+        calls.clear()
+        p = Pipeline([Node(flaky, retries=1)])
+        p.lock()
+        with self.assertRaises(ConnectionError):
+            p.push(7)
+
+    def test_timeout_releases_the_device(self):
+        dev = Device("slow", 1)
+
+        def hang(x):
+            if x == 0:
+                time.sleep(1)
+            return x
+
+        p = Pipeline([Node(hang, dev=dev, timeout=0.1)], parallel=True, workers=2,
+                     errors="capture")
+        with p:
+            begin = time.monotonic()
+            assert sorted(p.process(range(4))) == [1, 2, 3]
+            assert time.monotonic() - begin < 0.8
+        assert isinstance(p.failures[0].error, NodeTimeoutError)
+        assert dev.__sem__.acquire(blocking=False)
+        assert p.stats()["0:hang"] == {"retries": 0, "timeouts": 1}
+
+    def test_async_timeout_and_retry(self):
+        attempts = []
+
+        async def slow_first(x):
+            attempts.append(x)
+            if len(attempts) == 1:
+                await asyncio.sleep(1)
+            return x
+
+        p = Pipeline([Node(slow_first, timeout=0.1, retries=1)])
+        p.lock()
+        assert asyncio.run(p.aprocess([5])) == [5]
+        assert p.stats()["0:slow_first"] == {"retries": 1, "timeouts": 1}
+
+        def hang(x):
+            time.sleep(1)
+
+        p = Pipeline([Node(hang, timeout=0.1)])
+        p.lock()
+        with self.assertRaises(NodeTimeoutError):
+            asyncio.run(p.aprocess([1]))
+
+    def test_counters_from_worker_processes(self):
+        p = Pipeline([Node(fails_once, retries=1)], parallel=True, workers=2,
+                     executor=ProcessPoolExecutor)
+        with p:
+            assert sorted(p.process(range(6))) == list(range(6))
+        assert p.stats()["0:fails_once"]["retries"] == 6
+
+    def test_sink_takes_no_retries(self):
+        with self.assertRaises(AssertionError):
+            Node(batch_double, flush_size=2, retries=1)
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "run.ckpt")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_resume_after_a_crash(self):
+        crash = [True]
+
+        def work(x):
+            if x == 57 and crash[0]:
+                raise ValueError(x)
+            return x
+
+        p = Pipeline([work])
+        p.set_checkpoint(self.path, every=10)
+        p.lock()
+        with self.assertRaises(ValueError):
+            p.process(range(100))
+        assert Checkpoint.read(self.path) == (57, [])
+        crash[0] = False
+        assert p.process(range(100), resume_from=self.path) == list(range(57, 100))
+        assert Checkpoint.read(self.path)[0] == 100
+        assert p.process(range(100), resume_from=95) == list(range(95, 100))
+
+    def test_resume_without_a_saved_checkpoint(self):
+        assert Checkpoint.read(self.path) == (0, [])
+        p = Pipeline([plus_one])
+        p.set_checkpoint(self.path, every=10)
+        p.lock()
+        # the same call starts a run and resumes it
+        assert p.process(range(20), resume_from=self.path) == list(range(1, 21))
+        assert Checkpoint.read(self.path) == (20, [])
+
+    def test_out_of_order_completion(self):
+        done = set()
+
+        def work(x):
+            time.sleep(random.random() / 500)
+            if x == 150:
+                time.sleep(0.05)
+                raise ValueError(x)
+            done.add(x)
+            return x
+
+        for kwargs in ({"parallel": True, "workers": 6},
+                       {"staged": True, "workers": 3}):
+            done.clear()
+            saved = []
+            p = Pipeline([work, Node(plus_one, workers=2)], **kwargs)
+            p.set_checkpoint(self.path, every=5)
+            with p:
+                for _ in p.iprocess(range(150)):
+                    saved.append(Checkpoint.read(self.path)[0] if os.path.exists(self.path) else 0)
+                    assert set(range(saved[-1])) <= done, kwargs
+                with self.assertRaises(ValueError):
+                    p.process(range(400))
+            offset, _ = Checkpoint.read(self.path)
+            assert offset <= 150 and set(range(offset)) <= done, kwargs
+            assert saved == sorted(saved) and saved[-1] > 0, kwargs
+            os.remove(self.path)
+
+    def test_flatmap_filter_and_captured_items(self):
+        p = Pipeline([Node(repeat_item, kind="flatmap"), Node(is_even, kind="filter"),
+                      fail_on_three], errors="capture", parallel=True, workers=3)
+        p.set_checkpoint(self.path, every=3)
+        with p:
+            p.process(range(1, 30))
+        assert Checkpoint.read(self.path)[0] == 29
+
+    def test_pending_batches_are_written_on_resume(self):
+        written = []
+        crash = [True]
+
+        def work(x):
+            if x == 10 and crash[0]:
+                raise ValueError(x)
+            return x
+
+        p = Pipeline([work, Node(written.extend, flush_size=100)])
+        p.set_checkpoint(self.path, every=4)
+        p.lock()
+        with self.assertRaises(ValueError):
+            p.process(range(20))
+        assert written == [] and Checkpoint.read(self.path) == (10, [list(range(10))])
+        crash[0] = False
+        p.process(range(20), resume_from=self.path)
+        assert written == list(range(20))
+
+    def test_process_pool(self):
+        p = Pipeline([square], parallel=True, workers=2, executor=ProcessPoolExecutor)
+        p.set_checkpoint(self.path, every=10)
+        with p:
+            assert sorted(p.process(range(50), resume_from=20)) == [x * x for x in range(20, 50)]
+        assert Checkpoint.read(self.path)[0] == 50
+
+
+class TestAutoscale(unittest.TestCase):
+    def test_scales_up_waiting_work(self):
+        def io(x):
+            time.sleep(0.005)
+            return x
+
+        p = Pipeline([io], parallel=True, workers=16)
+        p.set_autoscale(min_workers=1, interval=0.05)
+        with p, self.assertLogs("Pipeline", "INFO") as logs:
+            assert sorted(p.process(range(800))) == list(range(800))
+        scaler = p.get_autoscaler()
+        assert scaler.decisions[0]["from"] == 1
+        assert max(d["workers"] for d in scaler.decisions) >= 6
+        assert all(1 <= d["workers"] <= 16 for d in scaler.decisions)
+        assert "autoscale up 1 -> 2 workers" in logs.output[0]
+
+    def test_backs_off_a_busy_device(self):
+        def io(x):
+            time.sleep(0.005)
+            return x
+
+        p = Pipeline([Node(io, dev=Device("db", 1))], parallel=True, workers=8, ordered=True)
+        p.set_autoscale(min_workers=1, interval=0.05)
+        with p:
+            assert p.process(range(300)) == list(range(300))
+        decisions = p.get_autoscaler().decisions
+        assert any("Devices" in d["reason"] for d in decisions)
+        assert max(d["workers"] for d in decisions) <= 4
+        assert p.stats()["0:io"]["calls"] == 300
+
+    def test_holds_while_latency_outgrows_throughput(self):
+        class Stats:
+            calls, total_time, wait_time = 0, 0.0, 0.0
+
+        class FakeMetrics:
+            nodes = {"0:io": Stats()}
+
+        def interval(scaler, items, latency):
+            stats = FakeMetrics.nodes["0:io"]
+            stats.calls += items
+            stats.total_time += items * latency
+            scaler.__pulled__ = items
+            scaler.__since__ = time.perf_counter() - 1.0
+            return scaler.decide()
+
+        for latency, action in ((0.010, "up"), (0.030, "hold")):
+            FakeMetrics.nodes["0:io"] = Stats()
+            scaler = Autoscaler(min_workers=4, max_workers=16)
+            scaler.begin([], FakeMetrics())
+            assert interval(scaler, 100, 0.010)["action"] == "up"
+            decision = interval(scaler, 150, latency)
+            assert decision["action"] == action, decision
+        assert "latency outgrows throughput" in decision["reason"]
+
+    def test_needs_a_parallel_pipeline(self):
+        with self.assertRaises(AssertionError):
+            Pipeline([square]).set_autoscale()
+        p = Pipeline([square], parallel=True, workers=2)
+        p.set_autoscale(max_workers=4)
+        assert p.get_autoscaler().max_workers == 4
+        p.set_parallel(parallel=True, workers=2)
+        assert p.get_autoscaler() is None
+
+
+class TestClone(unittest.TestCase):
+    def test_template_shares_nodes_and_plan(self):
+        template = Pipeline([plus_one, Node(pair_with, refer=["tenant"])])
+        template.lock()
+        a, b = template.clone(tenant="a"), template.clone(tenant="b")
+        assert a.process([1, 2]) == [(2, "a"), (3, "a")]
+        assert b.push(1) == (2, "b")
+        assert asyncio.run(a.aprocess([1])) == [(2, "a")]
+        assert a.__tasks__[1] is template.__tasks__[1]
+        assert a.__plan__ is template.__plan__
+        assert a.holding == {"tenant": "a"} and "tenant" not in template.holding
+
+    def test_parallel_clones_run_on_their_own(self):
+        template = Pipeline([square], parallel=True, workers=2)
+        template.lock()
+        with template.clone() as a:
+            template.shutdown()
+            assert sorted(a.process(range(5))) == [0, 1, 4, 9, 16]
+            assert sorted(asyncio.run(a.aprocess(range(3)))) == [0, 1, 4]
+        template.start()
+        assert sorted(template.process(range(3))) == [0, 1, 4]
+        template.shutdown()
+
+    def test_state_is_not_shared(self):
+        batches = []
+        sub = Pipeline([plus_one])
+        sub.lock()
+        template = Pipeline([Node(fails_once, retries=1), sub,
+                             Node(Branch(sub, square)),
+                             Node(batches.append, flush_size=10)], metrics=True)
+        template.lock()
+        a = template.clone()
+        assert a.process([100, 200]) == [(102, 10201), (202, 40401)]
+        assert batches == [[(102, 10201), (202, 40401)]]
+        assert a.__tasks__[1] is not sub and a.__tasks__[2].get_fn().branches[0] is not sub
+        assert a.stats()["0:fails_once"]["retries"] == 2
+        assert a.stats()["0:fails_once"]["calls"] == 4
+        assert template.stats()["0:fails_once"]["retries"] == 0
+        assert template.stats()["0:fails_once"]["calls"] == 0
+        assert template.__tasks__[0].get_fn() is a.__tasks__[0].get_fn()
+
+    def test_unlocked_clone(self):
+        template = Pipeline([plus_one])
+        a = template.clone()
+        a.add(square)
+        a.lock()
+        assert a.push(2) == 9
+        assert len(template.__tasks__) == 1
+
+
 if __name__ == "__main__":
     unittest.main()